@@ -0,0 +1,236 @@
+import os
+import os.path
+import sys
+sys.path.insert(0, os.path.abspath("./diffusers/src"))
+# The suite runs on cpu, must be set before pipes.backend is imported
+os.environ.setdefault("INPAINT_DEVICE", "cpu")
+# Every run must generate its images, not read them from the result cache
+os.environ.setdefault("INPAINT_RESULT_CACHE_MB", "0")
+
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+####################################
+# Tiny model
+####################################
+# Same architecture as the real model with tiny widths and random weights, so that the suite runs
+# in seconds on cpu without the model cache. Absolute numbers say nothing about the real model,
+# compare them between commits only.
+def build_tiny_tokenizer(vocab_size: int):
+	''' A CLIP tokenizer without merges, every word is <|endoftext|>. Only the token count matters here. '''
+	from transformers import CLIPTokenizer
+	tokenizer_dir = tempfile.mkdtemp(prefix="tiny_tokenizer_")
+	vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+	for i in range(2, vocab_size):
+		vocab[f"t{i}</w>"] = i
+	with open(os.path.join(tokenizer_dir, "vocab.json"), mode="w", encoding="utf8") as f:
+		json.dump(vocab, f)
+	with open(os.path.join(tokenizer_dir, "merges.txt"), mode="w", encoding="utf8") as f:
+		f.write("#version: 0.2\n")
+	return CLIPTokenizer(os.path.join(tokenizer_dir, "vocab.json"), os.path.join(tokenizer_dir, "merges.txt"))
+
+def build_tiny_pipe():
+	import torch
+	from transformers import CLIPTextConfig, CLIPTextModel, CLIPVisionConfig, CLIPConfig, CLIPFeatureExtractor
+	from diffusers import StableDiffusionPipeline, AutoencoderKL, UNet2DConditionModel
+	from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+	from pipes.backend import backend
+	from pipes.samplers import make_scheduler
+	from pipes.get_pipe import PipeRegistry
+
+	torch.manual_seed(0)
+	text_config = CLIPTextConfig(vocab_size=1000, hidden_size=32, intermediate_size=37, num_hidden_layers=2,
+		num_attention_heads=4, max_position_embeddings=77, bos_token_id=0, eos_token_id=1, pad_token_id=1)
+	vision_config = CLIPVisionConfig(hidden_size=32, intermediate_size=37, num_hidden_layers=2,
+		num_attention_heads=4, image_size=32, patch_size=4)
+	pipe = StableDiffusionPipeline(
+		vae=AutoencoderKL(
+			in_channels=3,
+			out_channels=3,
+			# 4 blocks, so that latents are 8 times smaller than images as with the real vae
+			down_block_types=["DownEncoderBlock2D"] * 4,
+			up_block_types=["UpDecoderBlock2D"] * 4,
+			block_out_channels=[32, 32, 32, 32],
+			latent_channels=4,
+		),
+		text_encoder=CLIPTextModel(text_config),
+		tokenizer=build_tiny_tokenizer(text_config.vocab_size),
+		unet=UNet2DConditionModel(
+			sample_size=32,
+			in_channels=4,
+			out_channels=4,
+			down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+			up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+			block_out_channels=(32, 64),
+			layers_per_block=2,
+			cross_attention_dim=32,
+		),
+		scheduler=make_scheduler("ddim"),
+		safety_checker=StableDiffusionSafetyChecker(CLIPConfig.from_text_vision_configs(text_config, vision_config, projection_dim=32)),
+		feature_extractor=CLIPFeatureExtractor(size=32, crop_size=32),
+	)
+	return PipeRegistry(backend.prepare(pipe))
+
+
+####################################
+# Stages
+####################################
+def time_runs(run, repeats: int) -> list:
+	''' Seconds of each of `repeats` calls to `run`, after one warm up call. '''
+	run()
+	seconds = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		run()
+		seconds.append(time.perf_counter() - start)
+	return seconds
+
+def bench_predict(pipe, mode: str, batch_size: int, args) -> dict:
+	import PIL.Image
+	import numpy as np
+	from pipes.backend import backend
+	import pipes.txt2img, pipes.img2img, pipes.inpaint
+
+	size = args.size
+	rng = np.random.default_rng(0)
+	init_image = PIL.Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+	mask = np.zeros((size, size, 3), dtype=np.uint8)
+	mask[size // 4:size * 3 // 4, size // 4:size * 3 // 4] = 255
+	mask_image = PIL.Image.fromarray(mask)
+
+	step_times = []
+	def callback(step, total_steps, latents):
+		step_times.append(time.perf_counter())
+
+	kwargs = dict(prompt="1girl, anime", num_inference_steps=args.steps, guidance_scale=7.5, eta=0.0,
+		pipe=pipe, batch_size=batch_size, callback=callback)
+	def run():
+		step_times.clear()
+		generator = backend.generator().manual_seed(0)
+		if mode == "txt2img":
+			pipes.txt2img.predict(height=size, width=size, generator=generator, **kwargs)
+		elif mode == "img2img":
+			pipes.img2img.predict(init_image=init_image, strength=1.0, generator=generator, **kwargs)
+		else:
+			pipes.inpaint.predict(init_image=init_image, mask_image=mask_image, keep_origin=True, strength=1.0, generator=generator, **kwargs)
+
+	seconds = time_runs(run, args.repeats)
+	step_seconds = [b - a for a, b in zip(step_times, step_times[1:])]
+	return {
+		"seconds": statistics.median(seconds),
+		"step_seconds": statistics.median(step_seconds) if len(step_seconds) > 0 else 0.0,
+		"images_per_second": batch_size / statistics.median(seconds),
+		"peak_rss": pipe.last_run["peak_memory"],
+	}
+
+def bench_export(args) -> dict:
+	import PIL.Image
+	import numpy as np
+	from png_cache import encode_png
+	from export import zip_to_bytes
+
+	rng = np.random.default_rng(0)
+	images = [PIL.Image.fromarray(rng.integers(0, 256, (512, 512, 3), dtype=np.uint8)) for _ in range(args.export_images)]
+	results = {}
+	seconds = time_runs(lambda: [encode_png(image) for image in images], args.repeats)
+	results["png"] = {
+		"seconds": statistics.median(seconds),
+		"images_per_second": len(images) / statistics.median(seconds),
+	}
+	entries = [(f"{i}.png", image) for i, image in enumerate(images)]
+	seconds = time_runs(lambda: zip_to_bytes(entries), args.repeats)
+	results["zip"] = {
+		"seconds": statistics.median(seconds),
+		"images_per_second": len(images) / statistics.median(seconds),
+	}
+	return results
+
+
+####################################
+# Compare
+####################################
+# Metrics where higher is better, the others are lower is better
+higher_is_better = ["images_per_second"]
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+	''' Metrics of `current` worse than `baseline` by more than `threshold` (relative), as printable lines. '''
+	regressions = []
+	for name, metrics in current["results"].items():
+		for metric, value in metrics.items():
+			base = baseline["results"].get(name, {}).get(metric)
+			if base is None or base == 0:
+				continue
+			change = (value - base) / base
+			if metric in higher_is_better:
+				change = -change
+			if change > threshold:
+				regressions.append(f"{name}.{metric}: {base:.4g} -> {value:.4g} ({change:+.1%} worse)")
+	return regressions
+
+def git_commit() -> str:
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+####################################
+# Main
+####################################
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the pipes and the export helpers on cpu with a tiny random model.")
+	parser.add_argument("--out", default="benchmark.json", help="JSON file to write the results to.")
+	parser.add_argument("--compare", default=None, help="Baseline JSON to compare with, exits with 1 on regressions.")
+	parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression.")
+	parser.add_argument("--steps", type=int, default=10)
+	parser.add_argument("--size", type=int, default=64)
+	parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 2])
+	parser.add_argument("--repeats", type=int, default=3)
+	parser.add_argument("--export-images", type=int, default=8)
+	args = parser.parse_args()
+
+	import torch
+	from pipes.backend import backend
+	print(backend)
+
+	results = {}
+	start = time.perf_counter()
+	pipe = build_tiny_pipe()
+	results["build"] = {"seconds": time.perf_counter() - start}
+	for mode in ["txt2img", "img2img", "inpaint"]:
+		for batch_size in args.batch_sizes:
+			name = f"{mode}_batch{batch_size}"
+			results[name] = bench_predict(pipe, mode, batch_size, args)
+			print(f"{name:<20}{results[name]['seconds']:8.3f}s {results[name]['step_seconds'] * 1000:8.2f}ms/step {results[name]['images_per_second']:8.2f} images/s")
+	results.update(bench_export(args))
+	for name in ["png", "zip"]:
+		print(f"{name:<20}{results[name]['seconds']:8.3f}s {results[name]['images_per_second']:8.2f} images/s")
+
+	report = {
+		"meta": {
+			"commit": git_commit(),
+			"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"torch": torch.__version__,
+			"threads": torch.get_num_threads(),
+			"args": vars(args),
+		},
+		"results": results,
+	}
+	with open(args.out, mode="w", encoding="utf8") as f:
+		json.dump(report, f, indent=4)
+	print(">>> " + args.out)
+
+	if not args.compare is None:
+		with open(args.compare, mode="r", encoding="utf8") as f:
+			baseline = json.load(f)
+		regressions = compare(baseline, report, args.threshold)
+		for line in regressions:
+			print("Regression: " + line)
+		if len(regressions) > 0:
+			sys.exit(1)
+		print(f"No regression over {args.threshold:.0%} against {baseline['meta'].get('commit')}.")
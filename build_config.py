@@ -202,9 +202,12 @@ config = {
 	"prompts": prompts,
 	# seed: 随机数种子，如果指定为None的话就随机生成种子；否则应指定为一个很大很大的整数。
 	#    注意当eta不为0时，模型行为总是不确定的，哪怕给相同的种子也没用。
+	#    每张图片的种子由这个种子和图片的序号算出（记录在png的元数据里），和批次大小无关，可以单独重新生成其中一张。
 	"seed": None,
 	# n: 生成的图片数量
 	"n": 50,
+	# max_batch_size: 一次同时生成的图片数量上限，越大越快但显存占用越高。显存不足时会自动减半重试。
+	"max_batch_size": 4,
 	# height, width: 图片的尺寸，512x512是6G显存的上限了
 	# 512  x 512
 	# 640  x 384
@@ -213,8 +216,22 @@ config = {
 	# 1024 x 256
 	"height": 640,
 	"width": 384,
+	# tile_size: 如果不为None，unet和vae按tile_size x tile_size的重叠分块计算（接缝处融合），显存占用取决于分块大小而不是图片尺寸，从而可以生成超过上述上限的大图。
+	#    会向下取整到64的倍数（unet会将latent下采样3次）
+	# tile_overlap: 分块之间重叠的像素数，向下取整到64的倍数，最多为分块大小的一半
+	"tile_size": None,
+	"tile_overlap": 64,
+	# memory_profile: 显存占用方案。"fast"：最快；"balanced"：分片计算attention和vae解码；"low-memory"：在balanced基础上，text_encoder、unet等大模块不用时放在内存里。
+	"memory_profile": "fast",
+	# sampler: 采样方法，"ddim"、"pndm"、"lms"、"dpm-solver"（DPM-Solver++二阶多步，见pipes/dpm_solver.py）。dpm-solver大约20步就能达到ddim 50步的效果，num_inference_steps可以相应减少。
+	#    各采样方法在不同步数下的耗时：python -m pipes.samplers
+	"sampler": "ddim",
 	# keep_origin: 自用参数，只对inpaint有效。如果为True，那么会保证整张图片中没有被mask的部分一定100%不变，否则会有微小的变化（重复多次inpaint的话，看起来就像是guidance_scale很大的结果）。
 	"keep_origin": True,
+	# crop_to_mask: 只对inpaint有效。如果为True，只重绘mask的包围盒（向外扩展crop_padding像素），并缩放到crop_resolution大小后再计算，最后融合回原图。mask很小时比重绘整张图快得多。
+	"crop_to_mask": False,
+	"crop_padding": 32,
+	"crop_resolution": 512,
 	# strength: 只对inpaint和img2img有效，数值越大，AI重写的程度就越高。0~1范围内，默认为0.8
 	"strength": 0.8,
 	# num_inference_steps: 迭代次数，基本控制在30~100就够了，默认为50
@@ -243,20 +260,20 @@ config["prompt"]: str = JoinPrompt(config["prompts"])
 #################################
 # Check prompt length
 #################################
-def check_prompt_length(prompt):
-	from transformers import CLIPTokenizer
+def print_prompt_length(prompts, prompt):
+	from check_prompt import check_prompt_length, keyword_token_counts
 
-	tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14") 
-	tokens = tokenizer(prompt, truncation=False, return_tensors="pt")
-	tokens_len = tokens.input_ids.shape[-1]
+	for keyword, keyword_len in keyword_token_counts(prompts):
+		print(f"{keyword_len:4d} {keyword}")
 
-	if tokens_len > tokenizer.model_max_length:
-		print(f"Too many tokens of length {tokens_len}, while max_length is {tokenizer.model_max_length}.")
+	isprompt_valid, tokens_len, max_length = check_prompt_length(prompt)
+	if not isprompt_valid:
+		print(f"Too many tokens of length {tokens_len}, while max_length is {max_length}.")
 	else:
 		print(f"tokens_len: {tokens_len}.")
 
 if check_prompt_len:
-	check_prompt_length(config["prompt"])
+	print_prompt_length(config["prompts"], config["prompt"])
 
 
 
@@ -278,16 +295,57 @@ def TestEachKeyword(config):
 	return configs
 	
 
+def Sweep(config, prompts=None, seeds=None, guidance_scales=None, steps=None, strengths=None, resolutions=None):
+	''' 在config的基础上展开参数网格，逐个yield生成的config，不会一次性全部生成。
+	每个参数为None时使用config中的值，resolutions为(height, width)的列表。
+	prompt、分辨率、迭代次数相同的config会排在一起，这样text embedding缓存命中率最高，也方便合并成batch。
+	'''
+	import itertools
+	grid = itertools.product(
+		prompts or [config["prompt"]],
+		resolutions or [(config["height"], config["width"])],
+		steps or [config["num_inference_steps"]],
+		guidance_scales or [config["guidance_scale"]],
+		strengths or [config["strength"]],
+		seeds or [config["seed"]],
+	)
+	for index, (prompt, (height, width), step, guidance_scale, strength, seed) in enumerate(grid):
+		swept = dict(config)
+		if not prompts is None:
+			# prompts 是拼成 prompt 之前的关键字，换了 prompt 之后就没用了
+			swept.pop("prompts", None)
+		swept.update({
+			"prompt": prompt,
+			"height": height,
+			"width": width,
+			"num_inference_steps": step,
+			"guidance_scale": guidance_scale,
+			"strength": strength,
+			"seed": seed,
+		})
+		if not config["name"] is None:
+			swept["name"] = f"{config['name']}_{index}"
+		yield swept
+
+
 configs = [config]
 # configs = TestEachKeyword(config)
+# configs = Sweep(config, seeds=[1, 2, 3], guidance_scales=[5.5, 7.5], steps=[30, 50])
 
 
 
 #################################
 # Save the config file
 #################################
-print(">>> " + config_filepath)
-
-with open(config_filepath, mode="w", encoding="utf8") as f:
+# .jsonl: 每行一个config，边生成边写入，main.py也逐行读取
+def SaveConfigs(configs, config_filepath):
 	import json
-	json.dump(configs, f, indent=4)
+	with open(config_filepath, mode="w", encoding="utf8") as f:
+		if config_filepath.endswith(".jsonl"):
+			for config in configs:
+				f.write(json.dumps(config, ensure_ascii=False, separators=(",", ":")) + "\n")
+		else:
+			json.dump(list(configs), f, indent=4)
+
+print(">>> " + config_filepath)
+SaveConfigs(configs, config_filepath)
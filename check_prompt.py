@@ -1,11 +1,30 @@
-from transformers import CLIPTokenizer
-tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14") 
+from functools import lru_cache
+
+tokenizer_id = "openai/clip-vit-large-patch14"
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+	from transformers import CLIPTokenizer
+	return CLIPTokenizer.from_pretrained(tokenizer_id)
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+	''' Token count of `text` including the start & end tokens, as the text encoder sees it.
+	Only token ids are built, no tensor. Counts are memoized by text.
+	'''
+	from pipes.metrics import metrics
+	with metrics.span("tokenize"):
+		return len(get_tokenizer()(text, truncation=False)["input_ids"])
 
 def check_prompt_length(prompt):
-	tokens = tokenizer(prompt, truncation=False, return_tensors="pt")
-	tokens_len = tokens.input_ids.shape[-1]
+	max_length = get_tokenizer().model_max_length
+	tokens_len = count_tokens(prompt)
 
-	if tokens_len > tokenizer.model_max_length:
-		return (False, tokens_len, tokenizer.model_max_length)
+	if tokens_len > max_length:
+		return (False, tokens_len, max_length)
 	else:
-		return (True, tokens_len, tokenizer.model_max_length)
\ No newline at end of file
+		return (True, tokens_len, max_length)
+
+def keyword_token_counts(keywords) -> list:
+	''' (keyword, token count) of each keyword, without the start & end tokens. '''
+	return [(keyword, count_tokens(keyword) - 2) for keyword in keywords]
@@ -0,0 +1,57 @@
+import io
+import os
+import tempfile
+from collections import deque
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from concurrent.futures import ThreadPoolExecutor
+from png_cache import encode_png
+from pipes.metrics import metrics
+
+
+# PNGs are already compressed, deflating them again mostly wastes time.
+compressions = {
+	"store": ZIP_STORED,
+	"deflate": ZIP_DEFLATED,
+}
+
+
+####################################
+# Zip export
+####################################
+def write_zip(file, entries, compression: str = "store", encode=encode_png, max_workers: int = None):
+	''' Write `entries`, an iterable of (filename, data), to the zip `file`.
+	`data` is a PIL image, bytes or str. Images are encoded by `encode` on a thread pool and
+	written in the order of `entries` while later ones are still encoding, so only a few encoded
+	images are held in memory besides the archive itself.
+	'''
+	def to_bytes(entry):
+		filename, data = entry
+		if isinstance(data, (bytes, str)):
+			return filename, data
+		return filename, encode(data)
+
+	if max_workers is None:
+		max_workers = os.cpu_count() or 1
+	with metrics.span("zip"), ZipFile(file, "w", compression=compressions[compression]) as zip_file:
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			# Encode at most 2 entries per worker ahead of writing
+			pending = deque()
+			for entry in entries:
+				pending.append(executor.submit(to_bytes, entry))
+				if len(pending) >= 2 * max_workers:
+					zip_file.writestr(*pending.popleft().result())
+			while len(pending) > 0:
+				zip_file.writestr(*pending.popleft().result())
+
+def zip_to_bytes(entries, **kwargs) -> bytes:
+	zip_bytes_io = io.BytesIO()
+	write_zip(zip_bytes_io, entries, **kwargs)
+	return zip_bytes_io.getvalue()
+
+def zip_to_tempfile(entries, dir: str = None, **kwargs) -> str:
+	''' Write the zip to a temporary file on disk instead of memory, returns its path.
+	The caller is responsible for deleting it.
+	'''
+	with tempfile.NamedTemporaryFile(mode="wb", suffix=".zip", dir=dir, delete=False) as f:
+		write_zip(f, entries, **kwargs)
+		return f.name
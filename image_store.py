@@ -0,0 +1,75 @@
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+
+def snap_size(size, multiple: int) -> tuple:
+	return tuple(max(multiple, x - x % multiple) for x in size)
+
+def normalize_image(image, multiple: int = 64):
+	''' Convert to RGB and resize to multiples of `multiple`, which the model needs. '''
+	image = image.convert("RGB")
+	size = snap_size(image.size, multiple)
+	if size != image.size:
+		image = image.resize(size, resample=Image.LANCZOS)
+	return image
+
+
+####################################
+# Image store
+####################################
+class ImageHandle:
+	''' A normalized image with a content fingerprint computed once, e.g. to key widgets on reruns. '''
+	__slots__ = ("fingerprint", "image")
+
+	def __init__(self, fingerprint: str, image):
+		self.fingerprint = fingerprint
+		self.image = image
+
+	@property
+	def size(self):
+		return self.image.size
+
+
+class ImageStore:
+	''' Decodes and normalizes each image once and hands out handles to it.
+	Uploads are fingerprinted by their file bytes, so uploading the same file again reuses the
+	decoded image. At most `max_images` images are kept, least recently used first evicted.
+	'''
+	def __init__(self, multiple: int = 64, max_images: int = 16):
+		self.multiple = multiple
+		self.max_images = max_images
+		self._handles = OrderedDict() # fingerprint => handle
+		self._lock = threading.Lock()
+
+	def _get_or_add(self, fingerprint: str, load) -> ImageHandle:
+		with self._lock:
+			handle = self._handles.get(fingerprint)
+			if not handle is None:
+				self._handles.move_to_end(fingerprint)
+				return handle
+		handle = ImageHandle(fingerprint, normalize_image(load(), self.multiple))
+		with self._lock:
+			self._handles[fingerprint] = handle
+			while len(self._handles) > self.max_images:
+				self._handles.popitem(last=False)
+		return handle
+
+	def add_file(self, file) -> ImageHandle:
+		''' Add an uploaded file, or any binary file object. '''
+		data = file.getvalue() if hasattr(file, "getvalue") else file.read()
+		fingerprint = f"{self.multiple}:" + hashlib.sha256(data).hexdigest()
+		return self._get_or_add(fingerprint, lambda: Image.open(io.BytesIO(data)))
+
+	def add_image(self, image) -> ImageHandle:
+		image = normalize_image(image, self.multiple)
+		digest = hashlib.sha256(image.tobytes())
+		digest.update(f"{image.size}".encode())
+		fingerprint = f"{self.multiple}:" + digest.hexdigest()
+		return self._get_or_add(fingerprint, lambda: image)
+
+	def get(self, fingerprint: str) -> ImageHandle:
+		with self._lock:
+			return self._handles.get(fingerprint)
@@ -2,207 +2,285 @@ import os.path
 import sys
 sys.path.insert(0, os.path.abspath("./diffusers/src"))
 
-import json
+import argparse
+import functools
 import PIL
-from PIL.PngImagePlugin import PngInfo
+from image_store import normalize_image
+import runner
+from runner import modes, Manifest, Progress, load_configs, remaining_indices, image_config, prepare_run, run_config
+
+parser = argparse.ArgumentParser(description="Generate images from config files.")
+parser.add_argument("--memory-profile", default=None,
+	help="fast, balanced or low-memory. Overrides memory_profile of the configs.")
+parser.add_argument("--sampler", default=None,
+	help="ddim, pndm, lms or dpm-solver. Overrides sampler of the configs.")
+parser.add_argument("--config", nargs="+", default=None,
+	help="Config files (.json or .jsonl, - for JSON lines from stdin) to run without asking. Runs interactively if neither --config nor --watch is given.")
+parser.add_argument("--watch", default=None,
+	help="Spool directory to watch for new .json/.jsonl job files, moved to done/ or failed/ after running.")
+parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between scans of the --watch directory.")
+parser.add_argument("--mode", choices=modes, default="txt2img",
+	help="Mode of jobs without a \"mode\" entry.")
+parser.add_argument("--init-image", default=None, help="Init image of inpaint and img2img jobs without an \"init_image\" entry.")
+parser.add_argument("--mask-image", default=None, help="Mask image of inpaint jobs without a \"mask_image\" entry.")
+parser.add_argument("--index", type=int, nargs="+", default=None,
+	help="Only generate the images of these indices of each --config job, even if recorded in the manifest. Needs jobs with a seed.")
+parser.add_argument("--from-image", nargs="+", default=None,
+	help="Regenerate images saved by a run, from the config, mode and index in their metadata, into --out-dir.")
+parser.add_argument("--out-dir", default="./out")
+parser.add_argument("--workers", type=int, default=1,
+	help="Processes to run --config/--watch jobs on, each pinned to its share of the cores. CPU only.")
+parser.add_argument("--manifest", default=None,
+	help="File recording generated images, to resume an interrupted run. Defaults to <out-dir>/manifest.jsonl.")
+# The worker processes of the pool import this module as well, without running it
+if __name__ == "__main__":
+	args = parser.parse_args()
+
+	# Load pipe in background while asking the user for inputs
+	from pipes.get_pipe import lazy_pipe
+	lazy_pipe.start()
+
+	from pipes.metrics import metrics
+	if metrics.enabled and "INPAINT_METRICS_PORT" in os.environ:
+		metrics.serve(int(os.environ["INPAINT_METRICS_PORT"]))
+
+
+	def get_image_from_user(name, last_image_path):
+		while True:
+			print(f"Please specify {name}(empty if use the last one)(d to open a file explorer to select):")
+			if not last_image_path is None:
+				print(f"[{last_image_path}]")
+			image_path = input(">>> ")
+
+			if image_path == "d":
+				import tkinter.filedialog
+				image_path = tkinter.filedialog.askopenfilename(filetypes=[("Image", ".png .jpeg .bmp .gif")])
+				if image_path == "":
+					continue
+				print(f"Select {image_path}.")
+			elif image_path == "":
+				image_path = last_image_path
+
+			try:
+				image = normalize_image(PIL.Image.open(image_path))
+			except OSError:
+				print("Cannot open file: " + image_path)
+				continue
+			break
+		return (image, image_path)
 
-print("Loading pytorch...")
-import torch
 
-print("Loading pipe...")
-from pipes.get_pipe import pipe
+	def get_pipe():
+		if not lazy_pipe.ready():
+			print("Waiting for pipe to load...")
+		return lazy_pipe.get()
 
+	def run_configs(configs, mode: str, kwargs: dict, image_paths: list, out_dir: str, manifest: Manifest = None, progress: Progress = None):
+		if not args.memory_profile is None:
+			kwargs["memory_profile"] = args.memory_profile
+		if not args.sampler is None:
+			kwargs["sampler"] = args.sampler
+		def iter_runs():
+			for config_index, config in enumerate(configs):
+				print(f"Config {config_index}: {config.get('name', '')}")
+				yield prepare_run(config, mode, kwargs, out_dir, image_paths, manifest)
+		# Consecutive configs differing only in prompt or seed share batches
+		runner.run_configs(iter_runs(), get_pipe(), manifest, progress)
 
-def random_filename():
-	import uuid
-	return str(uuid.uuid4())
 
-def get_image_from_user(name, last_image_path):
-	while True:
-		print(f"Please specify {name}(empty if use the last one)(d to open a file explorer to select):")
-		if not last_image_path is None:
-			print(f"[{last_image_path}]")
-		image_path = input(">>> ")
-
-		if image_path == "d":
-			import tkinter.filedialog
-			image_path = tkinter.filedialog.askopenfilename(filetypes=[("Image", ".png .jpeg .bmp .gif")])
-			if image_path == "":
-				continue
-			print(f"Select {image_path}.")
-		elif image_path == "":
-			image_path = last_image_path
-
-		try:
-			image = PIL.Image.open(image_path)
-		except OSError:
-			print("Cannot open file: " + image_path)
-			continue
-		break
-	return (image, image_path)
-
-
-last_config_filepath: str = None
-last_sel_mode: str = None
-last_inpaint_init_image_path: str = None
-last_inpaint_mask_image_path: str = None
-last_img2img_init_image_path: str = None
-while True:
 	####################################
-	# Get config file
+	# Headless
 	####################################
-	quit_flag = False
+	@functools.lru_cache(maxsize=8)
+	def load_input_image(image_path):
+		return normalize_image(PIL.Image.open(image_path))
+
+	def job_inputs(config: dict):
+		''' Mode, input images and their paths of a job. A job may set its own "mode", "init_image"
+		and "mask_image", otherwise the ones from the command line are used.
+		'''
+		mode = config.get("mode", args.mode)
+		if not mode in modes:
+			raise ValueError(f"Invalid mode: {mode}")
+		kwargs: dict = {}
+		image_paths: list = []
+		for name in {"inpaint": ["init_image", "mask_image"], "img2img": ["init_image"]}.get(mode, []):
+			image_path = config.get(name, getattr(args, name))
+			if image_path is None:
+				raise ValueError(f"{name} is required in {mode} mode")
+			image_path = os.path.abspath(image_path)
+			kwargs[name] = load_input_image(image_path)
+			image_paths.append(image_path)
+		if not args.memory_profile is None:
+			kwargs["memory_profile"] = args.memory_profile
+		if not args.sampler is None:
+			kwargs["sampler"] = args.sampler
+		return mode, kwargs, image_paths
+
+	def run_jobs(configs, manifest: Manifest, progress: Progress, indices: list = None):
+		if not pool is None:
+			pool.run(((config, *job_inputs(config)) for config in configs), manifest, progress, indices)
+			return
+		def iter_runs():
+			for config_index, config in enumerate(configs):
+				mode, kwargs, image_paths = job_inputs(config)
+				print(f"Job {config_index} ({mode}): {config.get('name', '')}")
+				if not indices is None and config["seed"] is None:
+					print("Warning: the job has no seed, its images of --index are new images.")
+				yield prepare_run(config, mode, kwargs, args.out_dir, image_paths, manifest, indices)
+		# Consecutive jobs differing only in prompt or seed share batches
+		runner.run_configs(iter_runs(), get_pipe(), manifest, progress)
+
+	def regenerate(png_paths: list, manifest: Manifest):
+		''' Generate again the images saved at `png_paths`, one image each instead of their whole batches. '''
+		for png_path in png_paths:
+			config, mode, index = image_config(png_path)
+			_, kwargs, image_paths = job_inputs({**config, "mode": mode})
+			print(f"Regenerate {png_path}: image {index} of {config.get('name', '')} ({mode})")
+			run_config(config, mode, get_pipe(), kwargs, args.out_dir, image_paths, manifest, indices=[index])
+
+	def watch(spool_dir: str, manifest: Manifest):
+		''' Run job files as they appear in `spool_dir`, oldest first.
+		Write job files under another name and rename them into the directory, so half written files are not picked up.
+		'''
+		import time
+		import traceback
+		done_dir, failed_dir = os.path.join(spool_dir, "done"), os.path.join(spool_dir, "failed")
+		os.makedirs(done_dir, exist_ok=True)
+		os.makedirs(failed_dir, exist_ok=True)
+		progress = Progress(None)
+		print(f"Watching {spool_dir} for job files...")
+		while True:
+			job_files = [entry for entry in os.scandir(spool_dir) if entry.is_file() and entry.name.endswith((".json", ".jsonl"))]
+			if len(job_files) == 0:
+				time.sleep(args.poll_interval)
+				continue
+			for entry in sorted(job_files, key=lambda entry: entry.stat().st_mtime):
+				print("Job file: " + entry.path)
+				target_dir = done_dir
+				try:
+					run_jobs(load_configs(entry.path), manifest, progress)
+				except Exception:
+					traceback.print_exc()
+					target_dir = failed_dir
+				os.replace(entry.path, os.path.join(target_dir, entry.name))
+
+	if not args.config is None or not args.watch is None or not args.from_image is None:
+		os.makedirs(args.out_dir, exist_ok=True)
+		manifest = Manifest(args.manifest or os.path.join(args.out_dir, "manifest.jsonl"))
+		pool = None
+		if args.workers > 1:
+			from worker_pool import WorkerPool
+			pool = WorkerPool(get_pipe(), args.workers, args.out_dir)
+
+		if not args.config is None:
+			def iter_configs():
+				for config_filepath in args.config:
+					yield from load_configs(config_filepath)
+
+			# Count the images to do for the ETA, unless the jobs come from stdin, which can only be read once
+			total = None
+			if not "-" in args.config:
+				total = 0
+				for config in iter_configs():
+					mode, _, image_paths = job_inputs(config)
+					total += len(remaining_indices(config, mode, image_paths, manifest) if args.index is None else args.index)
+			run_jobs(iter_configs(), manifest, Progress(total), args.index)
+
+		if not args.from_image is None:
+			regenerate(args.from_image, manifest)
+
+		if not args.watch is None:
+			try:
+				watch(args.watch, manifest)
+			except KeyboardInterrupt:
+				pass
+		if not pool is None:
+			pool.close()
+		sys.exit(0)
+
+
+	last_config_filepath: str = None
+	last_sel_mode: str = None
+	last_inpaint_init_image_path: str = None
+	last_inpaint_mask_image_path: str = None
+	last_img2img_init_image_path: str = None
 	while True:
-		print("Please specify config file(empty if use the last one)(q for quit):")
-		if not last_config_filepath is None:
-			print(f"[{last_config_filepath}]")
-		config_filepath = input(">>> ")
-		if config_filepath == "":
-			config_filepath = last_config_filepath
-		elif config_filepath == "q":
-			quit_flag = True
+		####################################
+		# Get config file
+		####################################
+		quit_flag = False
+		while True:
+			print("Please specify config file(empty if use the last one)(q for quit):")
+			if not last_config_filepath is None:
+				print(f"[{last_config_filepath}]")
+			config_filepath = input(">>> ")
+			if config_filepath == "":
+				config_filepath = last_config_filepath
+			elif config_filepath == "q":
+				quit_flag = True
+				break
+			print("Using config file: " + config_filepath)
+			last_config_filepath = config_filepath
+
+			try:
+				configs = list(load_configs(config_filepath))
+			except OSError:
+				print("Cannot open file " + config_filepath)
+				continue
+			break
+		if quit_flag:
 			break
-		print("Using config file: " + config_filepath)
-		last_config_filepath = config_filepath
-
-		try:
-			with open(config_filepath, mode="r", encoding="utf8") as f:
-				configs = json.load(f)
-		except OSError:
-			print("Cannot open file " + config_filepath)
-			continue
-		break
-	if quit_flag:
-		break
 
 
-	####################################
-	# Select mode
-	####################################
-	while True:
-		print('''Select mode(empty if use the last one):
+		####################################
+		# Select mode
+		####################################
+		while True:
+			print('''Select mode(empty if use the last one):
 0. txt2img
 1. inpaint
 2. img2img''')
-		if not last_sel_mode is None:
-			print(f"[{last_sel_mode}]")
-		sel_mode = input(">>> ")
-		if sel_mode == "":
-			sel_mode = last_sel_mode
-		if not sel_mode in ["0", "1", "2"]:
-			print(f"Invalid mode: {sel_mode}")
-			continue
-		last_sel_mode = sel_mode
-		break
-
-
-
-	####################################
-	# vars shared between modes
-	####################################
-	pipe_func: None
-	kwargs: dict = {}
-	
-
-	####################################
-	# Prepare evaluting for each mode
-	####################################
-	# txt2img
-	if sel_mode == "0":
-		import pipes.txt2img as txt2img
-		pipe_func = txt2img.predict
-	# inpaint
-	elif sel_mode == "1":
-		init_image, last_inpaint_init_image_path = get_image_from_user("init image", last_inpaint_init_image_path)
-		kwargs["init_image"] = init_image
-
-		mask_image, last_inpaint_mask_image_path = get_image_from_user("mask image", last_inpaint_mask_image_path)
-		kwargs["mask_image"] = mask_image
-
-		import pipes.inpaint as inpaint
-		pipe_func = inpaint.predict
-	# img2img
-	elif sel_mode == "2":
-		init_image, last_img2img_init_image_path = get_image_from_user("init image", last_img2img_init_image_path)
-		kwargs["init_image"] = init_image
-
-		import pipes.img2img as img2img
-		pipe_func = img2img.predict
-
-
-
-	#################################
-	# Work on each config
-	#################################
-	for config_index in range(len(configs)):
-		config = configs[config_index]
-		print(f"Config {config_index}/{len(configs)}: {config.get('name', '')}")
-
-
-		#################################
-		# Set Seed
-		#################################
-		cuda_seed = torch.Generator(device='cuda')
-		manual_seed = config["seed"]
-		if manual_seed is None:
-			config["seed"] = str(cuda_seed.seed())
-		else:
-			cuda_seed = cuda_seed.manual_seed(manual_seed)
+			if not last_sel_mode is None:
+				print(f"[{last_sel_mode}]")
+			sel_mode = input(">>> ")
+			if sel_mode == "":
+				sel_mode = last_sel_mode
+			if not sel_mode in ["0", "1", "2"]:
+				print(f"Invalid mode: {sel_mode}")
+				continue
+			last_sel_mode = sel_mode
+			break
 
 
 
-		#################################
-		# Fill arguments
-		#################################
-		for key in ["prompt", "height", "width", "keep_origin", "strength", "num_inference_steps", "guidance_scale", "eta"]:
-			if key in config.keys():
-				kwargs[key] = config[key]
-		kwargs["pipe"] = pipe
-		kwargs["generator"] = cuda_seed
+		####################################
+		# vars shared between modes
+		####################################
+		kwargs: dict = {}
+		image_paths: list = []
 
 
+		####################################
+		# Prepare evaluting for each mode
+		####################################
+		# inpaint
+		if sel_mode == "1":
+			init_image, last_inpaint_init_image_path = get_image_from_user("init image", last_inpaint_init_image_path)
+			kwargs["init_image"] = init_image
 
-		#################################
-		# Build Png Metadata
-		#################################
-		metadata = PngInfo()
-		metadata.add_text("stable diffusion", json.dumps(config))
+			mask_image, last_inpaint_mask_image_path = get_image_from_user("mask image", last_inpaint_mask_image_path)
+			kwargs["mask_image"] = mask_image
+			image_paths = [last_inpaint_init_image_path, last_inpaint_mask_image_path]
+		# img2img
+		elif sel_mode == "2":
+			init_image, last_img2img_init_image_path = get_image_from_user("init image", last_img2img_init_image_path)
+			kwargs["init_image"] = init_image
+			image_paths = [last_img2img_init_image_path]
 
 
 
 		#################################
-		# Save Results
+		# Work on each config
 		#################################
-		# Output directory
-		import os.path
-		out_dir = "./out"
-
-		# Save metadata
-		metadata_filename:str = None
-		if config["name"] is None:
-			metadata_filename = random_filename()
-		else:
-			metadata_filename = config["name"]
-		metadata_file = os.path.join(out_dir, metadata_filename+".txt")
-		print("metadata_file: " + metadata_file)
-		with open(metadata_file, mode="w") as f:
-			json.dump(config, f, indent=4)
-
-		# Evalute & Save Image
-		for i in range(config["n"]):
-			## Gen filename
-			filename:str = None
-			if config["name"] is None:
-				filename = random_filename()
-			else:
-				filename = config["name"]
-				if i != 0:
-					filename += "_" + str(i)
-			filepath = os.path.join(out_dir, filename+".png")
-			print(f"{i}/{config['n']}: {filepath}")
-
-			## Evaluate
-			res_image: PIL.Image = pipe_func(**kwargs)
-			
-			## Save result image
-			res_image.save(filepath, pnginfo=metadata)
\ No newline at end of file
+		run_configs(configs, modes[int(sel_mode)], kwargs, image_paths, args.out_dir, progress=Progress(sum(config["n"] for config in configs)))
@@ -0,0 +1,83 @@
+import os
+import contextlib
+import torch
+
+
+####################################
+# Backend
+####################################
+# Selected by environment variables:
+#   INPAINT_DEVICE: "cuda", "cpu", "mps", ... Default "cuda" if available, otherwise "cpu".
+#   INPAINT_DTYPE: "fp16", "bf16" or "fp32". Default "fp16" on cuda, "fp32" on other devices.
+#   INPAINT_REVISION: revision of the model weights in model_cache. Default "fp16".
+#   INPAINT_THREADS: intra-op thread count of torch. Default torch's own choice.
+#   INPAINT_CHANNELS_LAST: "1" or "0", use channels_last memory format for the unet and vae. Default "1" on cpu.
+dtypes = {
+	"fp16": torch.float16,
+	"bf16": torch.bfloat16,
+	"fp32": torch.float32,
+}
+
+class Backend:
+	def __init__(self, device: str = None, dtype: str = None, revision: str = None, num_threads: int = None, channels_last: bool = None):
+		if device is None:
+			device = "cuda" if torch.cuda.is_available() else "cpu"
+		self.device = device
+		self.device_type = torch.device(device).type
+
+		if dtype is None:
+			dtype = "fp16" if self.device_type == "cuda" else "fp32"
+		if not dtype in dtypes:
+			raise ValueError(f"Unknown dtype {dtype}, should be one of {list(dtypes.keys())}.")
+		self.dtype_name = dtype
+		self.dtype = dtypes[dtype]
+
+		self.revision = "fp16" if revision is None else revision
+
+		self.num_threads = num_threads
+		if not num_threads is None:
+			torch.set_num_threads(num_threads)
+
+		if channels_last is None:
+			channels_last = self.device_type == "cpu"
+		self.channels_last = channels_last
+
+	@staticmethod
+	def from_env():
+		num_threads = os.environ.get("INPAINT_THREADS")
+		channels_last = os.environ.get("INPAINT_CHANNELS_LAST")
+		return Backend(
+			device=os.environ.get("INPAINT_DEVICE"),
+			dtype=os.environ.get("INPAINT_DTYPE"),
+			revision=os.environ.get("INPAINT_REVISION"),
+			num_threads=None if num_threads is None else int(num_threads),
+			channels_last=None if channels_last is None else channels_last == "1",
+		)
+
+	def __repr__(self):
+		return f"Backend(device={self.device}, dtype={self.dtype_name}, num_threads={torch.get_num_threads()}, channels_last={self.channels_last})"
+
+	def autocast(self):
+		''' Context to run the pipe in. '''
+		if self.device_type == "cuda" and self.dtype == torch.float16:
+			return torch.autocast("cuda")
+		if self.device_type == "cpu" and self.dtype == torch.bfloat16:
+			return torch.autocast("cpu", dtype=torch.bfloat16)
+		return contextlib.nullcontext()
+
+	def generator(self) -> torch.Generator:
+		# mps does not support torch.Generator, sample noise on cpu instead.
+		generator_device = "cpu" if self.device_type == "mps" else self.device
+		return torch.Generator(device=generator_device)
+
+	def prepare(self, pipe):
+		''' Move pipe to the device and apply memory format. '''
+		pipe = pipe.to(self.device)
+		if self.channels_last:
+			# Weights mapped from a prepared checkpoint are channels_last already and not copied, see `pipes.prepared`
+			pipe.unet.to(memory_format=torch.channels_last)
+			pipe.vae.to(memory_format=torch.channels_last)
+		return pipe
+
+
+backend = Backend.from_env()
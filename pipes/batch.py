@@ -0,0 +1,56 @@
+####################################
+# Out of memory detection
+####################################
+def is_out_of_memory(e: BaseException) -> bool:
+	# torch.cuda.OutOfMemoryError only exists since torch 1.13,
+	# older versions raise a plain RuntimeError.
+	return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+
+####################################
+# Batched predicting
+####################################
+def iter_batches(predict_batch, n: int, max_batch_size: int):
+	''' Call `predict_batch(start, batch_size)` until `n` images are generated, with batches of at most
+	`max_batch_size` images. Yields the list of images of each batch.
+	If a batch runs out of memory, the batch size is halved and the batch is retried,
+	the smaller batch size is kept for the following batches.
+	'''
+	batch_size = max(1, min(int(max_batch_size), n))
+	done = 0
+	while done < n:
+		cur_batch_size = min(batch_size, n - done)
+		try:
+			images = predict_batch(done, cur_batch_size)
+		except RuntimeError as e:
+			if not is_out_of_memory(e) or cur_batch_size == 1:
+				raise
+			# Not imported at the top, the GUI imports this module before the pipe has loaded torch
+			import torch
+			if torch.cuda.is_available():
+				torch.cuda.empty_cache()
+			batch_size = cur_batch_size // 2
+			print(f"Out of memory with batch_size {cur_batch_size}, retry with batch_size {batch_size}.")
+			continue
+		done += len(images)
+		yield images
+
+def iter_predict(predict_func, n: int, max_batch_size: int, **kwargs):
+	''' Generate `n` images by calling `predict_func(batch_size=..., **kwargs)` in batches, see `iter_batches`. '''
+	def predict_batch(start, batch_size):
+		return predict_func(batch_size=batch_size, **kwargs)
+	return iter_batches(predict_batch, n, max_batch_size)
+
+def iter_predict_items(predict_func, prompts: list, generators: list, max_batch_size: int, **kwargs):
+	''' Generate one image per item of `prompts` and `generators` in batches, see `iter_batches`.
+	Items are passed to `predict_func` as lists, so a batch can mix different prompts and generators.
+	'''
+	assert(len(prompts) == len(generators))
+	def predict_batch(start, batch_size):
+		return predict_func(
+			prompt=prompts[start:start+batch_size],
+			generator=generators[start:start+batch_size],
+			batch_size=batch_size,
+			**kwargs
+		)
+	return iter_batches(predict_batch, len(prompts), max_batch_size)
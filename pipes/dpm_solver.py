@@ -0,0 +1,52 @@
+import math
+from diffusers import DDIMScheduler
+
+
+####################################
+# DPM-Solver++
+####################################
+class DPMSolverScheduler(DDIMScheduler):
+	''' Second order multistep DPM-Solver++ (https://arxiv.org/abs/2211.01095) for the `step(model_output, t, sample)`
+	interface of the pipes of this diffusers version, which has no DPM-Solver of its own.
+	Timesteps, `add_noise` and the alphas are those of DDIM, so the pipes treat it as a DDIM scheduler.
+	Each step converts the predicted noise to a predicted original sample and combines it with the
+	one of the previous step. The first step, and the last one with fewer than 15 steps, are first order
+	for stability. `eta` is accepted and ignored, the solver is deterministic.
+	'''
+	def set_timesteps(self, num_inference_steps: int, offset: int = 0):
+		super().set_timesteps(num_inference_steps, offset)
+		# (timestep, predicted original sample) of the previous step
+		self.last_step = None
+
+	def _alpha_sigma(self, timestep: int) -> tuple:
+		alpha_prod = float(self.alphas_cumprod[timestep]) if timestep >= 0 else float(self.final_alpha_cumprod)
+		return alpha_prod ** 0.5, (1 - alpha_prod) ** 0.5
+
+	def _lambda(self, timestep: int) -> float:
+		alpha, sigma = self._alpha_sigma(timestep)
+		return math.log(alpha / sigma)
+
+	def step(self, model_output, timestep, sample, eta: float = 0.0, generator=None, return_dict: bool = True, **kwargs):
+		if self.num_inference_steps is None:
+			raise ValueError("Number of inference steps is 'None', you need to run 'set_timesteps' after creating the scheduler")
+		timestep = int(timestep)
+		prev_timestep = timestep - self.config.num_train_timesteps // self.num_inference_steps
+		alpha, sigma = self._alpha_sigma(timestep)
+		alpha_prev, sigma_prev = self._alpha_sigma(prev_timestep)
+
+		pred_original_sample = (sample - sigma * model_output) / alpha
+		h = self._lambda(prev_timestep) - self._lambda(timestep)
+		prev_sample = (sigma_prev / sigma) * sample - alpha_prev * math.expm1(-h) * pred_original_sample
+
+		last_step = self.last_step
+		lower_order_final = prev_timestep < 0 and self.num_inference_steps < 15
+		if not last_step is None and not lower_order_final:
+			last_timestep, last_original_sample = last_step
+			r = (self._lambda(timestep) - self._lambda(last_timestep)) / h
+			prev_sample = prev_sample - 0.5 * alpha_prev * math.expm1(-h) * (pred_original_sample - last_original_sample) / r
+		self.last_step = (timestep, pred_original_sample)
+
+		if not return_dict:
+			return (prev_sample,)
+		from diffusers.schedulers.scheduling_utils import SchedulerOutput
+		return SchedulerOutput(prev_sample=prev_sample)
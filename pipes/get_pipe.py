@@ -1,28 +1,205 @@
-import torch
-import streamlit as st
-from diffusers import StableDiffusionPipeline, DDIMScheduler
+import os.path
+import time
+import threading
+from contextlib import contextmanager
 
 ####################################
 # Build pipe
 ####################################
 model_id = "hakurei/waifu-diffusion"
-device = "cuda"
-
-import os.path
 model_cache_dir = "./model_cache"
 
-pipe = StableDiffusionPipeline.from_pretrained(
-    model_id,
-	cache_dir=model_cache_dir,
-    torch_dtype=torch.float16,
-    revision="fp16",
-    local_files_only=True,
-    scheduler=DDIMScheduler(
-        beta_start=0.00085,
-        beta_end=0.012,
-        beta_schedule="scaled_linear",
-        clip_sample=False,
-        set_alpha_to_one=False,
-    ),
-)
-pipe = pipe.to(device)
\ No newline at end of file
+
+class StartupTimer:
+	''' Records how long each stage of loading the pipe takes. '''
+	def __init__(self):
+		self.stages = []
+		self._last = time.perf_counter()
+		self._start = self._last
+
+	def lap(self, stage: str):
+		now = time.perf_counter()
+		self.stages.append((stage, now - self._last))
+		self._last = now
+
+	def report(self) -> str:
+		lines = ["Startup timing:"]
+		for stage, seconds in self.stages:
+			lines.append(f"  {stage:<24}{seconds:8.2f}s")
+		lines.append(f"  {'total':<24}{self._last - self._start:8.2f}s")
+		return "\n".join(lines)
+
+
+def load_pipe(timer: StartupTimer):
+	import torch
+	timer.lap("import torch")
+
+	from huggingface_hub import snapshot_download
+	from transformers import CLIPTokenizer, CLIPTextModel, CLIPFeatureExtractor
+	from diffusers import StableDiffusionPipeline, AutoencoderKL, UNet2DConditionModel
+	from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+	from pipes.backend import backend
+	from pipes.prepared import prepared_dir, is_prepared, load_component
+	from pipes.samplers import make_scheduler
+	timer.lap("import diffusers")
+
+	model_dir = snapshot_download(model_id, cache_dir=model_cache_dir, revision=backend.revision, local_files_only=True)
+	def component_dir(name):
+		return os.path.join(model_dir, name)
+
+	tokenizer = CLIPTokenizer.from_pretrained(component_dir("tokenizer"))
+	timer.lap("load tokenizer")
+	# Map the prepared checkpoint if `python -m pipes.prepared` has written it
+	target_dir = prepared_dir(model_cache_dir, model_id, backend.revision, backend.dtype_name, backend.channels_last)
+	if os.environ.get("INPAINT_PREPARED", "1") == "1" and is_prepared(target_dir):
+		text_encoder = load_component("text_encoder", target_dir)
+		timer.lap("map text_encoder")
+		vae = load_component("vae", target_dir)
+		timer.lap("map vae")
+		unet = load_component("unet", target_dir)
+		timer.lap("map unet")
+		safety_checker = load_component("safety_checker", target_dir)
+		timer.lap("map safety_checker")
+	else:
+		text_encoder = CLIPTextModel.from_pretrained(component_dir("text_encoder"), torch_dtype=backend.dtype)
+		timer.lap("load text_encoder")
+		vae = AutoencoderKL.from_pretrained(component_dir("vae"), torch_dtype=backend.dtype)
+		timer.lap("load vae")
+		unet = UNet2DConditionModel.from_pretrained(component_dir("unet"), torch_dtype=backend.dtype)
+		timer.lap("load unet")
+		safety_checker = StableDiffusionSafetyChecker.from_pretrained(component_dir("safety_checker"), torch_dtype=backend.dtype)
+		timer.lap("load safety_checker")
+	feature_extractor = CLIPFeatureExtractor.from_pretrained(component_dir("feature_extractor"))
+	timer.lap("load feature_extractor")
+
+	pipe = StableDiffusionPipeline(
+		vae=vae,
+		text_encoder=text_encoder,
+		tokenizer=tokenizer,
+		unet=unet,
+		scheduler=make_scheduler("ddim"),
+		safety_checker=safety_checker,
+		feature_extractor=feature_extractor,
+	)
+	pipe = backend.prepare(pipe)
+	if backend.device_type == "cuda":
+		torch.cuda.synchronize()
+	timer.lap(f"transfer to {backend.device}")
+	return PipeRegistry(pipe)
+
+
+####################################
+# Pipe registry
+####################################
+class PipeRegistry:
+	''' One pipeline object per mode, all built over the same components, so no weights are copied.
+	The pipelines share the device, use `use(mode)` to run one of them exclusively.
+	'''
+	def __init__(self, pipe):
+		from diffusers import StableDiffusionImg2ImgPipeline, StableDiffusionInpaintPipeline
+		from pipes.text_cache import CachedTextEncoder
+		self.text_encoder_cache = CachedTextEncoder(pipe.text_encoder, model_id,
+			max_bytes=int(os.environ.get("INPAINT_EMBEDDING_CACHE_MB", 64)) * 1024 * 1024)
+		pipe.text_encoder = self.text_encoder_cache
+		self.components = {
+			"vae": pipe.vae,
+			"text_encoder": pipe.text_encoder,
+			"tokenizer": pipe.tokenizer,
+			"unet": pipe.unet,
+			"scheduler": pipe.scheduler,
+			"safety_checker": pipe.safety_checker,
+			"feature_extractor": pipe.feature_extractor,
+		}
+		self.pipes = {
+			"txt2img": pipe,
+			"img2img": StableDiffusionImg2ImgPipeline(**self.components),
+			"inpaint": StableDiffusionInpaintPipeline(**self.components),
+		}
+		self.schedulers = {"ddim": pipe.scheduler} # sampler name => scheduler
+		self.lock = threading.RLock()
+		self.last_run = None
+		from pipes.backend import backend
+		from pipes.result_cache import result_cache_from_env
+		self.result_cache = result_cache_from_env(f"{model_id}@{backend.revision}/{backend.dtype_name}/{backend.device_type}")
+		from pipes.metrics import metrics
+		metrics.gauge("inpaint_text_cache_hits", lambda: self.text_encoder_cache.stats()["hits"])
+		metrics.gauge("inpaint_text_cache_misses", lambda: self.text_encoder_cache.stats()["misses"])
+		self.memory_profile = "fast"
+		self.offload = None
+
+	def get(self, mode: str):
+		return self.pipes[mode]
+
+	def get_scheduler(self, sampler: str):
+		from pipes.samplers import make_scheduler
+		with self.lock:
+			if not sampler in self.schedulers:
+				self.schedulers[sampler] = make_scheduler(sampler)
+			return self.schedulers[sampler]
+
+	@contextmanager
+	def use(self, mode: str, images: int = 1, memory_profile: str = None, sampler: str = None):
+		''' Run the pipe of `mode` exclusively, its latency & peak memory are kept in `last_run`.
+		`memory_profile` switches the profile of all pipes (see `pipes.memory.profiles`), None keeps the current one.
+		`sampler` is the scheduler used during this run (see `pipes.samplers`), None means "ddim".
+		'''
+		from pipes.backend import backend
+		from pipes.memory import measure_run, set_memory_profile
+		from pipes.metrics import metrics, stage_spans
+		sampler = "ddim" if sampler is None else sampler
+		with self.lock:
+			if not memory_profile is None:
+				set_memory_profile(self, memory_profile)
+			mode_pipe = self.pipes[mode]
+			scheduler = mode_pipe.scheduler
+			mode_pipe.scheduler = self.get_scheduler(sampler)
+			try:
+				with measure_run(backend.device_type) as stats, metrics.span(mode), stage_spans(mode_pipe):
+					yield mode_pipe
+			finally:
+				mode_pipe.scheduler = scheduler
+			self.last_run = {"mode": mode, "memory_profile": self.memory_profile, "sampler": sampler, "images": images, **stats}
+			metrics.inc("inpaint_images_total", images, mode=mode)
+
+
+####################################
+# Lazy pipe
+####################################
+class LazyPipe:
+	''' Loads the pipe in a background thread, so that the caller can do other things meanwhile.
+	`start()` begins loading, `get()` blocks until the pipe is loaded.
+	'''
+	def __init__(self):
+		self.timer = None
+		self._pipe = None
+		self._error = None
+		self._thread = None
+		self._lock = threading.Lock()
+
+	def start(self):
+		with self._lock:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._load, name="load_pipe", daemon=True)
+				self._thread.start()
+		return self
+
+	def _load(self):
+		self.timer = StartupTimer()
+		try:
+			self._pipe = load_pipe(self.timer)
+		except BaseException as e:
+			self._error = e
+		print(self.timer.report())
+
+	def ready(self) -> bool:
+		return not self._thread is None and not self._thread.is_alive()
+
+	def get(self):
+		self.start()
+		self._thread.join()
+		if not self._error is None:
+			raise RuntimeError("Failed to load pipe.") from self._error
+		return self._pipe
+
+
+lazy_pipe = LazyPipe()
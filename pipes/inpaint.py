@@ -1,15 +1,54 @@
 import torch
 import PIL
-from diffusers import StableDiffusionInpaintPipeline
+from PIL import Image, ImageFilter
+from pipes.backend import backend
+from pipes.tiling import tiled
+from pipes.preview import step_callback
+from pipes.metrics import metrics
+from pipes.noise import per_item_noise
+
+
+####################################
+# Crop to mask
+####################################
+def mask_crop_box(mask_image: PIL.Image, padding: int, multiple: int = 64) -> tuple:
+	''' Bounding box of the masked (white) pixels, padded by `padding` pixels, grown to multiples of
+	`multiple` and aligned to the latent grid (8 pixels). Returns None if nothing is masked.
+	'''
+	# point() & getbbox() run in C over the whole mask
+	bbox = mask_image.convert("L").point(lambda v: 255 if v >= 128 else 0).getbbox()
+	if bbox is None:
+		return None
+
+	def expand(low, high, size):
+		low = max(0, low - padding)
+		high = min(size, high + padding)
+		length = -(-(high - low) // multiple) * multiple
+		# Grow around the center, shift back inside the image at its borders
+		box_low = max(0, min(low - (length - (high - low)) // 2, size - length))
+		box_low -= box_low % 8
+		# Aligning moved the box left, grow it again so that it still reaches `high`
+		length = -(-(high - box_low) // multiple) * multiple
+		return box_low, min(size, box_low + length)
+
+	left, right = expand(bbox[0], bbox[2], mask_image.size[0])
+	top, bottom = expand(bbox[1], bbox[3], mask_image.size[1])
+	return (left, top, right, bottom)
+
+def model_size(size: tuple, resolution: int) -> tuple:
+	''' Scale `size` so that its longer side is `resolution`, in multiples of 64. '''
+	scale = resolution / max(size)
+	return tuple(max(64, round(x * scale / 64) * 64) for x in size)
 
 
 ####################################
 # Interface for predicting
 ####################################
-def predict(prompt: str, init_image: PIL.Image, mask_image: PIL.Image, keep_origin: bool, strength: float, num_inference_steps: int, guidance_scale: float, eta: float, generator: torch.Generator, pipe=None, **kwargs) -> PIL.Image:
+def predict(prompt: str, init_image: PIL.Image, mask_image: PIL.Image, keep_origin: bool, strength: float, num_inference_steps: int, guidance_scale: float, eta: float, generator, pipe=None, batch_size: int = 1, tile_size: int = None, tile_overlap: int = 64, memory_profile: str = None, sampler: str = None, callback=None, crop_to_mask: bool = False, crop_padding: int = 32, crop_resolution: int = 512, **kwargs) -> list:
 	''' Args (copied from StableDiffusionInpaintPipeline.__call__):
 		prompt (`str` or `List[str]`):
 			The prompt or prompts to guide the image generation.
+			A `str` is shared by the whole batch, a `List[str]` gives the prompt of each image.
 		init_image (`torch.FloatTensor` or `PIL.Image.Image`):
 			`Image`, or tensor representing an image batch, that will be used as the starting point for the
 			process. This is the image whose masked region will be inpainted.
@@ -34,36 +73,87 @@ def predict(prompt: str, init_image: PIL.Image, mask_image: PIL.Image, keep_orig
 		eta (`float`, *optional*, defaults to 0.0):
 			Corresponds to parameter eta (η) in the DDIM paper: https://arxiv.org/abs/2010.02502. Only applies to
 			[`schedulers.DDIMScheduler`], will be ignored for others.
-		generator (`torch.Generator`, *optional*):
+		generator (`torch.Generator` or `List[torch.Generator]`, *optional*):
 			A [torch generator](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make generation
 			deterministic.
+			Can also be a list of generators, one per image, the noise of each image is then drawn from its own generator.
 		output_type (`str`, *optional*, defaults to `"pil"`):
 			The output format of the generate image. Choose between
 			[PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `nd.array`.
 		return_dict (`bool`, *optional*, defaults to `True`):
 			Whether or not to return a [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] instead of a
 			plain tuple.
+		pipe (`PipeRegistry`):
+			The registry from `pipes.get_pipe`. The "inpaint" pipeline is run while holding its lock.
+		batch_size (`int`, *optional*, defaults to 1):
+			How many images are generated in one batched denoising loop.
+		tile_size (`int`, *optional*, defaults to None):
+			If set, the unet and the vae work on overlapping tiles of `tile_size` pixels whose seams are blended,
+			so peak memory is bounded by the tile size instead of the image size. `tile_overlap` is in pixels too.
+		memory_profile (`str`, *optional*, defaults to None):
+			"fast", "balanced" or "low-memory", see `pipes.memory.profiles`. None keeps the current profile.
+		sampler (`str`, *optional*, defaults to None):
+			"ddim", "pndm", "lms" or "dpm-solver", see `pipes.samplers`. None means "ddim".
+		callback (`Callable[[int, int, torch.FloatTensor], None]`, *optional*):
+			Called after each denoising step with (step, total steps, latents), see `pipes.preview`.
+			Raise `pipes.preview.Cancelled` in it to stop the run.
+		crop_to_mask (`bool`, *optional*, defaults to False):
+			If True, only the bounding box of the mask, padded by `crop_padding` pixels, is inpainted.
+			The crop is scaled so that its longer side is `crop_resolution`, inpainted, then scaled back and
+			blended into `init_image`. Much cheaper than inpainting the whole image when the mask is small.
+
+	Returns a list of images, `batch_size` of them or one per prompt if `prompt` is a list.
 	'''
-	pipe.__class__ = StableDiffusionInpaintPipeline
+	prompts = prompt if isinstance(prompt, list) else [prompt] * batch_size
+
+	box = None
+	pipe_init_image, pipe_mask_image = init_image, mask_image
+	if crop_to_mask:
+		box = mask_crop_box(mask_image, crop_padding)
+		if box is None:
+			# Nothing to inpaint
+			return [init_image.copy() for _ in prompts]
+		crop_size = (box[2] - box[0], box[3] - box[1])
+		pipe_size = model_size(crop_size, crop_resolution)
+		with metrics.span("crop"):
+			pipe_init_image = init_image.crop(box).resize(pipe_size, resample=Image.LANCZOS)
+			pipe_mask_image = mask_image.crop(box).resize(pipe_size, resample=Image.NEAREST)
 
-	with torch.autocast("cuda"):
-		image = pipe(
-			prompt, 
-			init_image,
-			mask_image,
+	with pipe.use("inpaint", len(prompts), memory_profile, sampler) as mode_pipe, tiled(mode_pipe, tile_size, tile_overlap), per_item_noise(mode_pipe, generator) as generator, step_callback(mode_pipe, callback, int(num_inference_steps * strength)), backend.autocast():
+		images = mode_pipe(
+			prompts, 
+			pipe_init_image,
+			pipe_mask_image,
 			strength=strength,
 			num_inference_steps=num_inference_steps, 
 			guidance_scale=guidance_scale, 
 			eta=eta, 
 			generator=generator,
-		)["images"][0]
+		)["images"]
+
+	if not box is None:
+		# Blend the crops back into init_image through the mask, feathered unless keeping origin
+		paste_mask = mask_image.crop(box)
+		if keep_origin:
+			paste_mask = paste_mask.convert("1")
+		else:
+			paste_mask = paste_mask.convert("L").filter(ImageFilter.GaussianBlur(radius=max(1, crop_padding // 4)))
+		res_images = []
+		with metrics.span("crop_paste"):
+			for image in images:
+				res_image = init_image.copy()
+				res_image.paste(image.resize(crop_size, resample=Image.LANCZOS), box[:2], paste_mask)
+				res_images.append(res_image)
+		return res_images
+
 	if keep_origin:
 		L_mask_image = mask_image.convert("1")
-		res_image = init_image.copy()
-		res_image.paste(image, None, L_mask_image)
-		return res_image
+		res_images = []
+		with metrics.span("keep_origin"):
+			for image in images:
+				res_image = init_image.copy()
+				res_image.paste(image, None, L_mask_image)
+				res_images.append(res_image)
+		return res_images
 	else:
-		return image
-
-
-
+		return images
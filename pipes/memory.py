@@ -0,0 +1,174 @@
+import os
+import time
+import threading
+import torch
+from contextlib import contextmanager
+
+
+####################################
+# Peak memory & latency
+####################################
+def peak_rss() -> int:
+	''' Peak resident memory over the whole life of the process in bytes, 0 if unknown. '''
+	try:
+		import resource
+	except ImportError:
+		# Not available on Windows
+		return 0
+	# ru_maxrss is in KB on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def current_rss() -> int:
+	''' Resident memory of the process in bytes, None if unknown. Only Linux exposes it cheaply. '''
+	try:
+		with open("/proc/self/statm", mode="rb") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except (OSError, ValueError, AttributeError):
+		return None
+
+class RssPeak:
+	''' Peak resident memory between `start()` and `stop()`, sampled every `interval` seconds in a daemon thread.
+	Spikes shorter than `interval` may be missed.
+	'''
+	def __init__(self, interval: float = 0.01):
+		self.interval = interval
+		self.peak = 0
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="rss_peak", daemon=True)
+
+	def _run(self):
+		while True:
+			self.peak = max(self.peak, current_rss() or 0)
+			if self._stop.wait(self.interval):
+				break
+
+	def start(self):
+		self.peak = current_rss() or 0
+		self._thread.start()
+
+	def stop(self) -> int:
+		self._stop.set()
+		self._thread.join()
+		return max(self.peak, current_rss() or 0)
+
+@contextmanager
+def measure_run(device_type: str):
+	''' Yields a dict that is filled with "seconds", "peak_memory" (bytes) and "peak_scope" when the context exits.
+	On cuda the peak is the memory allocated by torch during the context ("run"). Otherwise it is the RSS sampled
+	during the context ("run"), or the peak RSS of the whole process where the RSS cannot be sampled ("process").
+	'''
+	stats = {}
+	rss_peak = None
+	if device_type == "cuda":
+		torch.cuda.synchronize()
+		torch.cuda.reset_peak_memory_stats()
+	elif not current_rss() is None:
+		rss_peak = RssPeak()
+		rss_peak.start()
+	start = time.perf_counter()
+	try:
+		yield stats
+	finally:
+		stats["peak_scope"] = "run"
+		if device_type == "cuda":
+			torch.cuda.synchronize()
+			stats["peak_memory"] = torch.cuda.max_memory_allocated()
+		elif not rss_peak is None:
+			stats["peak_memory"] = rss_peak.stop()
+		else:
+			stats["peak_memory"] = peak_rss()
+			stats["peak_scope"] = "process"
+		stats["seconds"] = time.perf_counter() - start
+
+def format_run(stats: dict) -> str:
+	return (f"{stats['mode']} ({stats['memory_profile']}, {stats['sampler']}): {stats['images']} images in {stats['seconds']:.2f}s "
+		f"({stats['seconds'] / stats['images']:.2f}s/image), {'process ' if stats.get('peak_scope') == 'process' else ''}peak memory {stats['peak_memory'] / 1024**2:.0f}MB")
+
+
+####################################
+# Memory profiles
+####################################
+# attention_slicing: compute attention in slices, see StableDiffusionPipeline.enable_attention_slicing.
+# vae_slicing: decode the latents of a batch one image at a time.
+# offload: keep the big components (text encoder, unet, safety checker) on cpu, only the one running is on the device.
+profiles = {
+	"fast": {"attention_slicing": False, "vae_slicing": False, "offload": False},
+	"balanced": {"attention_slicing": True, "vae_slicing": True, "offload": False},
+	"low-memory": {"attention_slicing": True, "vae_slicing": True, "offload": True},
+}
+
+class ComponentOffload:
+	''' Keeps `modules` on cpu and moves each one to `device` right before its forward,
+	moving the previous one back to cpu, so at most one of them is on the device at a time.
+	The vae stays on the device, the pipes take their device from it.
+	'''
+	def __init__(self, modules: list, device: str):
+		self.modules = modules
+		self.device = device
+		self.current = None
+		self.handles = []
+
+	def _pre_hook(self, module, args):
+		if self.current is module:
+			return
+		if not self.current is None:
+			self.current.to("cpu")
+		module.to(self.device)
+		self.current = module
+
+	def enable(self):
+		for module in self.modules:
+			module.to("cpu")
+			self.handles.append(module.register_forward_pre_hook(self._pre_hook))
+		if torch.cuda.is_available():
+			torch.cuda.empty_cache()
+
+	def disable(self):
+		for handle in self.handles:
+			handle.remove()
+		self.handles = []
+		for module in self.modules:
+			module.to(self.device)
+		self.current = None
+
+def enable_vae_slicing(vae):
+	decode = vae.decode
+	def sliced_decode(z, **kwargs):
+		outputs = [decode(z[i:i+1], **kwargs) for i in range(z.shape[0])]
+		if isinstance(outputs[0], tuple):
+			return (torch.cat([output[0] for output in outputs]),)
+		return type(outputs[0])(sample=torch.cat([output["sample"] for output in outputs]))
+	vae.decode = sliced_decode
+
+def disable_vae_slicing(vae):
+	vae.__dict__.pop("decode", None)
+
+def set_memory_profile(registry, name: str):
+	''' Switch the memory profile of all pipes in `registry`, the caller must hold its lock. '''
+	if registry.memory_profile == name:
+		return
+	if not name in profiles:
+		raise ValueError(f"Unknown memory profile {name}, should be one of {list(profiles.keys())}.")
+	profile = profiles[name]
+	pipe = registry.get("txt2img")
+
+	if profile["attention_slicing"]:
+		pipe.enable_attention_slicing()
+	else:
+		pipe.disable_attention_slicing()
+
+	disable_vae_slicing(pipe.vae)
+	if profile["vae_slicing"]:
+		enable_vae_slicing(pipe.vae)
+
+	if not registry.offload is None:
+		registry.offload.disable()
+		registry.offload = None
+	if profile["offload"]:
+		from pipes.backend import backend
+		# The text encoder is wrapped by the embedding cache, offload the wrapped one
+		modules = [pipe.text_encoder.text_encoder, pipe.unet, pipe.safety_checker]
+		registry.offload = ComponentOffload([module for module in modules if not module is None], backend.device)
+		registry.offload.enable()
+
+	registry.memory_profile = name
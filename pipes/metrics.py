@@ -0,0 +1,199 @@
+import os
+import time
+import bisect
+import functools
+import threading
+import contextlib
+from pipes.patch import patch_attrs
+
+
+####################################
+# Metrics
+####################################
+# Enabled by environment variables:
+#   INPAINT_METRICS: "1" to record timing spans, counters and gauges. Default "0", spans are then a shared no-op context.
+#   INPAINT_METRICS_FILE: file to write the Prometheus text format to, after each config of main.py.
+#   INPAINT_METRICS_PORT: port to serve the Prometheus text format on, at any path.
+# With --workers, the worker processes send what they record to main.py, which alone writes and serves it.
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_null_span = contextlib.nullcontext()
+
+
+class Histogram:
+	def __init__(self):
+		self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value: float):
+		self.counts[bisect.bisect_left(buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+
+def format_labels(labels: tuple, **extra) -> str:
+	labels = list(labels) + list(extra.items())
+	if len(labels) == 0:
+		return ""
+	return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Metrics:
+	''' Histograms, counters and gauges keyed by name and labels, rendered in the Prometheus text format.
+	`span(stage)` times a block into the "inpaint_stage_seconds" histogram.
+	When disabled every method returns at once, so instrumented code pays about one attribute lookup.
+	'''
+	def __init__(self, enabled: bool):
+		self.enabled = enabled
+		self._lock = threading.Lock()
+		self._histograms = {} # (name, labels) => Histogram
+		self._counters = {} # (name, labels) => value
+		self._gauges = {} # (name, labels) => function returning the value
+
+	def span(self, stage: str):
+		if not self.enabled:
+			return _null_span
+		return self._span(stage)
+
+	@contextlib.contextmanager
+	def _span(self, stage: str):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe("inpaint_stage_seconds", time.perf_counter() - start, stage=stage)
+
+	def observe(self, name: str, value: float, **labels):
+		if not self.enabled:
+			return
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			histogram = self._histograms.get(key)
+			if histogram is None:
+				histogram = self._histograms[key] = Histogram()
+			histogram.observe(value)
+
+	def inc(self, name: str, value: float = 1, **labels):
+		if not self.enabled:
+			return
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + value
+
+	def gauge(self, name: str, func, **labels):
+		''' Register `func()` as the value of a gauge, it is called when rendering. '''
+		if not self.enabled:
+			return
+		with self._lock:
+			self._gauges[(name, tuple(sorted(labels.items())))] = func
+
+	def take(self) -> dict:
+		''' The histograms and counters recorded since the last call, as plain data, e.g. to send them to another process. '''
+		with self._lock:
+			histograms, self._histograms = self._histograms, {}
+			counters, self._counters = self._counters, {}
+		return {
+			"histograms": {key: (h.counts, h.sum, h.count) for key, h in histograms.items()},
+			"counters": counters,
+		}
+
+	def merge(self, taken: dict):
+		''' Add histograms and counters returned by `take`. '''
+		if not self.enabled:
+			return
+		with self._lock:
+			for key, (counts, total, count) in taken["histograms"].items():
+				histogram = self._histograms.get(key)
+				if histogram is None:
+					histogram = self._histograms[key] = Histogram()
+				histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+				histogram.sum += total
+				histogram.count += count
+			for key, value in taken["counters"].items():
+				self._counters[key] = self._counters.get(key, 0) + value
+
+	def render(self) -> str:
+		with self._lock:
+			histograms = [(key, list(h.counts), h.sum, h.count) for key, h in self._histograms.items()]
+			counters = list(self._counters.items())
+			gauges = list(self._gauges.items())
+		lines = []
+		typed = set()
+		def add_type(name, kind):
+			if not name in typed:
+				typed.add(name)
+				lines.append(f"# TYPE {name} {kind}")
+		for (name, labels), counts, total, count in sorted(histograms):
+			add_type(name, "histogram")
+			cumulative = 0
+			for le, bucket_count in zip([*map(str, buckets), "+Inf"], counts):
+				cumulative += bucket_count
+				lines.append(f"{name}_bucket{format_labels(labels, le=le)} {cumulative}")
+			lines.append(f"{name}_sum{format_labels(labels)} {total}")
+			lines.append(f"{name}_count{format_labels(labels)} {count}")
+		for (name, labels), value in sorted(counters):
+			add_type(name, "counter")
+			lines.append(f"{name}{format_labels(labels)} {value}")
+		for (name, labels), func in sorted(gauges, key=lambda gauge: gauge[0]):
+			add_type(name, "gauge")
+			lines.append(f"{name}{format_labels(labels)} {func()}")
+		return "\n".join(lines) + "\n"
+
+	def write(self, path: str):
+		''' Write atomically, so that a scraper never reads a partial file. '''
+		if not self.enabled:
+			return
+		tmp_path = f"{path}.{os.getpid()}.tmp"
+		with open(tmp_path, mode="w", encoding="utf8") as f:
+			f.write(self.render())
+		os.replace(tmp_path, path)
+
+	def serve(self, port: int) -> threading.Thread:
+		''' Serve the metrics over http in a daemon thread. '''
+		from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+		metrics = self
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = metrics.render().encode("utf8")
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+			def log_message(self, format, *args):
+				pass
+		server = ThreadingHTTPServer(("", port), Handler)
+		thread = threading.Thread(target=server.serve_forever, name="metrics_server", daemon=True)
+		thread.start()
+		return thread
+
+
+metrics = Metrics(os.environ.get("INPAINT_METRICS", "0") == "1")
+
+
+####################################
+# Stage spans of a pipe
+####################################
+@contextlib.contextmanager
+def stage_spans(mode_pipe):
+	''' Time the unet steps, vae encode/decode and the safety checker of `mode_pipe` during the context.
+	Methods are replaced on the instances with `pipes.patch.patch_attrs`, the caller must hold the registry's lock.
+	'''
+	if not metrics.enabled:
+		yield
+		return
+	def timed(stage, func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with metrics.span(stage):
+				return func(*args, **kwargs)
+		return wrapper
+	patches = [
+		(mode_pipe.unet, "forward", "unet"),
+		(mode_pipe.vae, "encode", "vae_encode"),
+		(mode_pipe.vae, "decode", "vae_decode"),
+		(mode_pipe.safety_checker, "forward", "safety_checker"),
+	]
+	with patch_attrs([(obj, name, timed(stage, getattr(obj, name))) for obj, name, stage in patches if not obj is None]):
+		yield
@@ -0,0 +1,102 @@
+import copy
+import functools
+import hashlib
+import torch
+from contextlib import contextmanager
+from pipes.patch import patch_attrs
+
+
+####################################
+# Per image seeds
+####################################
+def image_seed(seed, index: int) -> int:
+	''' Seed of the `index`-th image generated with the batch seed `seed`.
+	Each image gets its own generator seeded with it, so any image can be generated alone, in any batch.
+	'''
+	digest = hashlib.blake2b(f"{int(seed)}:{index}".encode(), digest_size=8).digest()
+	return int.from_bytes(digest, "little") & (2**63 - 1)
+
+def image_generators(seed, indices) -> list:
+	from pipes.backend import backend
+	return [backend.generator().manual_seed(image_seed(seed, index)) for index in indices]
+
+
+####################################
+# Per item noise
+####################################
+# The predict functions accept a list of generators, one per batch item, so that items from
+# different requests can share one batch while each keeps the noise of its own generator.
+# Noise is always drawn from fresh generators in the initial state of the given ones: the pipes
+# draw from the generator they are passed, and a batch retried after running out of memory reuses
+# generators advanced by the failed attempt, so an item's noise depends on its seed only.
+# DDIM with eta > 0 draws its step noise from the generator passed to the pipe, the first item's,
+# so images are not reproducible per image then.
+
+# The pipes scale the vae latents by this
+vae_scale = 0.18215
+
+def fresh_generators(generators: list) -> list:
+	return [torch.Generator(generator.device).manual_seed(generator.initial_seed()) for generator in generators]
+
+def randn_per_item(shape, generators: list, device) -> torch.Tensor:
+	''' Sample a batch of noise whose i-th item is drawn from `generators[i]`. `shape` excludes the batch dimension. '''
+	return torch.cat([
+		torch.randn((1, *shape), generator=generator, device=generator.device)
+		for generator in generators
+	]).to(device)
+
+def per_item_latents(mode_pipe, generator, height: int, width: int):
+	''' Returns (latents, generator) to pass to a txt2img pipe.
+	If `generator` is a list, latents are sampled per item, otherwise the pipe samples them itself.
+	'''
+	if not isinstance(generator, list):
+		return None, generator
+	shape = (mode_pipe.unet.in_channels, height // 8, width // 8)
+	return randn_per_item(shape, fresh_generators(generator), mode_pipe.device), generator[0]
+
+@contextmanager
+def per_item_noise(mode_pipe, generator):
+	''' Context for img2img/inpaint pipes, yields the generator to pass to the pipe.
+	If `generator` is a list, the vae posterior sample of the init image and the noise added to it
+	are sampled per item. The pipe samples the posterior once for the whole batch and the noise once,
+	then passes both to `scheduler.add_noise`. So during the context the posterior's `sample` returns
+	its mean, and a copy of the scheduler is used whose `add_noise` adds the per item posterior
+	samples and replaces the noise. `vae.encode` is replaced on the instance, the caller must hold the registry's lock.
+	'''
+	if not isinstance(generator, list):
+		yield generator
+		return
+
+	vae = mode_pipe.vae
+	vae_encode = vae.encode
+	posterior = {}
+	@functools.wraps(vae_encode)
+	def encode_mean(*args, **kwargs):
+		output = vae_encode(*args, **kwargs)
+		latent_dist = output[0] if isinstance(output, tuple) else output["latent_dist"]
+		posterior["std"] = latent_dist.std
+		latent_dist.sample = lambda generator=None: latent_dist.mean
+		return output
+
+	scheduler = mode_pipe.scheduler
+	hooked_scheduler = copy.deepcopy(scheduler)
+	add_noise = hooked_scheduler.add_noise
+	noises = {}
+	def add_noise_per_item(original_samples, noise, timesteps):
+		# inpaint calls add_noise with the same init latents and noise on every step, keep doing so
+		if not "noise" in noises:
+			item_generators = fresh_generators(generator)
+			shape = noise.shape[1:]
+			posterior_noise = randn_per_item(shape, item_generators, noise.device)
+			noises["noise"] = randn_per_item(shape, item_generators, noise.device).to(noise.dtype)
+			noises["init_latents"] = original_samples
+			noises["item_init_latents"] = original_samples
+			if "std" in posterior:
+				noises["item_init_latents"] = (original_samples.float() + vae_scale * posterior["std"].float() * posterior_noise).to(original_samples.dtype)
+		if original_samples is noises["init_latents"]:
+			original_samples = noises["item_init_latents"]
+		return add_noise(original_samples, noises["noise"], timesteps)
+	hooked_scheduler.add_noise = add_noise_per_item
+
+	with patch_attrs([(vae, "encode", encode_mean), (mode_pipe, "scheduler", hooked_scheduler)]):
+		yield generator[0]
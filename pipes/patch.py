@@ -0,0 +1,27 @@
+from contextlib import contextmanager
+
+
+####################################
+# Instance patching
+####################################
+_missing = object()
+
+@contextmanager
+def patch_attrs(patches: list):
+	''' Set the attributes `patches`, a list of (object, name, value), during the context.
+	Afterwards each instance gets back exactly what it had: an attribute it did not have itself, e.g. a
+	method of its class, is deleted again, one already replaced on it, e.g. by offload hooks, is restored.
+	Replacing methods of the pipes on their instances is not thread safe, the caller must hold the registry's lock.
+	Wrappers replacing a method should keep its signature with `functools.wraps`, the pipes inspect some of them.
+	'''
+	saved = [(obj, name, obj.__dict__.get(name, _missing)) for obj, name, _ in patches]
+	for obj, name, value in patches:
+		setattr(obj, name, value)
+	try:
+		yield
+	finally:
+		for obj, name, value in reversed(saved):
+			if value is _missing:
+				delattr(obj, name)
+			else:
+				setattr(obj, name, value)
@@ -0,0 +1,170 @@
+import os
+import json
+import shutil
+import ctypes
+import contextlib
+import torch
+
+
+####################################
+# Prepared checkpoints
+####################################
+# A prepared component is a directory with:
+#   config.json: the config of the model, copied from the checkpoint
+#   weights.bin: the raw bytes of all tensors, already in the target dtype, each aligned to `alignment` bytes
+#   index.json:  {name: [dtype, shape, offset, memory format]}, written last, so a directory with it is complete
+# Loading maps weights.bin copy-on-write instead of unpickling it, pages are read when first touched.
+# With channels_last, the 4D weights of the components `Backend.prepare` converts are written in that
+# memory format, so converting the mapped modules copies nothing into anonymous memory.
+alignment = 64
+components = ["text_encoder", "vae", "unet", "safety_checker"]
+channels_last_components = ["vae", "unet"]
+
+
+def component_classes() -> dict:
+	from transformers import CLIPTextModel
+	from diffusers import AutoencoderKL, UNet2DConditionModel
+	from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+	return {
+		"text_encoder": CLIPTextModel,
+		"vae": AutoencoderKL,
+		"unet": UNet2DConditionModel,
+		"safety_checker": StableDiffusionSafetyChecker,
+	}
+
+def prepared_dir(model_cache_dir: str, model_id: str, revision: str, dtype_name: str, channels_last: bool = False) -> str:
+	memory_format = "-channels_last" if channels_last else ""
+	return os.path.join(model_cache_dir, "prepared", f"{model_id.replace('/', '--')}-{revision}-{dtype_name}{memory_format}")
+
+def is_prepared(target_dir: str) -> bool:
+	return all(os.path.exists(os.path.join(target_dir, name, "index.json")) for name in components)
+
+
+def write_component(module: torch.nn.Module, source_dir: str, target_dir: str, channels_last: bool = False):
+	os.makedirs(target_dir, exist_ok=True)
+	shutil.copyfile(os.path.join(source_dir, "config.json"), os.path.join(target_dir, "config.json"))
+	index = {}
+	offset = 0
+	with open(os.path.join(target_dir, "weights.bin"), mode="wb") as f:
+		for name, tensor in module.state_dict().items():
+			tensor = tensor.detach().cpu()
+			memory_format = "channels_last" if channels_last and tensor.dim() == 4 else "contiguous"
+			# Stored as NHWC, mapped back as a NCHW view with channels_last strides
+			tensor = tensor.permute(0, 2, 3, 1).contiguous() if memory_format == "channels_last" else tensor.contiguous()
+			padding = -offset % alignment
+			f.write(b"\0" * padding)
+			offset += padding
+			nbytes = tensor.numel() * tensor.element_size()
+			f.write(ctypes.string_at(tensor.data_ptr(), nbytes))
+			shape = [tensor.shape[i] for i in (0, 3, 1, 2)] if memory_format == "channels_last" else list(tensor.shape)
+			index[name] = [str(tensor.dtype).replace("torch.", ""), shape, offset, memory_format]
+			offset += nbytes
+	with open(os.path.join(target_dir, "index.json"), mode="w", encoding="utf8") as f:
+		json.dump(index, f)
+
+def prepare_checkpoint(model_dir: str, target_dir: str, dtype: torch.dtype, channels_last: bool = False):
+	''' Convert the components of the checkpoint in `model_dir` to `dtype`, and the memory format if `channels_last`,
+	and write them prepared to `target_dir`.
+	'''
+	for name, cls in component_classes().items():
+		print(f"Preparing {name}...")
+		module = cls.from_pretrained(os.path.join(model_dir, name), torch_dtype=dtype)
+		write_component(module, os.path.join(model_dir, name), os.path.join(target_dir, name), channels_last and name in channels_last_components)
+
+
+@contextlib.contextmanager
+def skip_init():
+	''' Skip the random initialization of weights while building modules, they are replaced anyway. '''
+	from transformers.modeling_utils import no_init_weights
+	names = ["uniform_", "normal_", "trunc_normal_", "constant_", "zeros_", "ones_", "xavier_uniform_", "xavier_normal_", "kaiming_uniform_", "kaiming_normal_"]
+	saved = {name: getattr(torch.nn.init, name) for name in names}
+	for name in names:
+		setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+	try:
+		with no_init_weights(True):
+			yield
+	finally:
+		for name, func in saved.items():
+			setattr(torch.nn.init, name, func)
+
+def set_tensor(module: torch.nn.Module, name: str, tensor: torch.Tensor):
+	*path, leaf = name.split(".")
+	for part in path:
+		module = getattr(module, part)
+	if leaf in module._parameters:
+		module._parameters[leaf] = torch.nn.Parameter(tensor, requires_grad=False)
+	else:
+		module._buffers[leaf] = tensor
+
+def load_component(name: str, target_dir: str) -> torch.nn.Module:
+	''' Build the module of component `name` and map its prepared weights. '''
+	cls = component_classes()[name]
+	component_dir = os.path.join(target_dir, name)
+	with skip_init():
+		if hasattr(cls, "config_class"):
+			# transformers models
+			module = cls(cls.config_class.from_pretrained(component_dir))
+		else:
+			module = cls.from_config(component_dir)
+
+	with open(os.path.join(component_dir, "index.json"), mode="r", encoding="utf8") as f:
+		index = json.load(f)
+	weights_path = os.path.join(component_dir, "weights.bin")
+	weights = torch.from_file(weights_path, shared=False, size=os.path.getsize(weights_path), dtype=torch.uint8)
+	# Directories written before the memory format was recorded have 3 fields, all contiguous
+	for tensor_name, (dtype, shape, offset, *memory_format) in index.items():
+		dtype = getattr(torch, dtype)
+		nbytes = torch.Size(shape).numel() * torch.empty((), dtype=dtype).element_size()
+		tensor = weights[offset:offset+nbytes].view(dtype)
+		if memory_format == ["channels_last"]:
+			n, c, h, w = shape
+			tensor = tensor.view(n, h, w, c).permute(0, 3, 1, 2)
+		else:
+			tensor = tensor.view(shape)
+		set_tensor(module, tensor_name, tensor)
+	return module.eval()
+
+
+####################################
+# Prepare & compare
+####################################
+# python -m pipes.prepared
+if __name__ == "__main__":
+	import sys
+	sys.path.insert(0, os.path.abspath("./diffusers/src"))
+	import time
+	from huggingface_hub import snapshot_download
+	from pipes.backend import backend
+	from pipes.get_pipe import model_id, model_cache_dir
+
+	model_dir = snapshot_download(model_id, cache_dir=model_cache_dir, revision=backend.revision, local_files_only=True)
+	target_dir = prepared_dir(model_cache_dir, model_id, backend.revision, backend.dtype_name, backend.channels_last)
+	if not is_prepared(target_dir):
+		prepare_checkpoint(model_dir, target_dir, backend.dtype, backend.channels_last)
+	print(f"Prepared checkpoint: {target_dir}")
+
+	def to_memory_format(name, module):
+		''' The conversion of `Backend.prepare`, a copy of each 4D weight unless it is already channels_last. '''
+		if backend.channels_last and name in channels_last_components:
+			module.to(memory_format=torch.channels_last)
+		return module
+
+	def read_all(module):
+		''' Read every weight, mapped weights are only read from disk when first touched. '''
+		with torch.no_grad():
+			return sum(float(tensor.float().sum()) for tensor in [*module.parameters(), *module.buffers()])
+
+	# Both columns include the memory format conversion of `Backend.prepare` and reading every weight once,
+	# so they compare the same work. "mapped" is the time until the component can be used, its pages are
+	# read by the first forward then.
+	print(f"{'component':<16}{'from_pretrained':>16}{'prepared':>12}{'mapped':>10}")
+	for name, cls in component_classes().items():
+		start = time.perf_counter()
+		read_all(to_memory_format(name, cls.from_pretrained(os.path.join(model_dir, name), torch_dtype=backend.dtype)))
+		pretrained_seconds = time.perf_counter() - start
+		start = time.perf_counter()
+		module = to_memory_format(name, load_component(name, target_dir))
+		mapped_seconds = time.perf_counter() - start
+		read_all(module)
+		prepared_seconds = time.perf_counter() - start
+		print(f"{name:<16}{pretrained_seconds:15.2f}s{prepared_seconds:11.2f}s{mapped_seconds:9.2f}s")
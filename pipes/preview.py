@@ -0,0 +1,63 @@
+import inspect
+import functools
+import torch
+from PIL import Image
+from contextlib import contextmanager
+from pipes.patch import patch_attrs
+
+
+class Cancelled(Exception):
+	''' Raise in a step callback to stop the denoising loop. '''
+	pass
+
+
+####################################
+# Latent previews
+####################################
+# Approximate linear map from the 4 latent channels of the stable diffusion vae to RGB,
+# orders of magnitude cheaper than decoding with the vae.
+latent_rgb_factors = [
+	[ 0.298,  0.207,  0.208],
+	[ 0.187,  0.286,  0.173],
+	[-0.158,  0.189,  0.264],
+	[-0.184, -0.271, -0.473],
+]
+
+def latents_to_previews(latents: torch.Tensor, scale: int = 4) -> list:
+	''' Approximate images of `latents` (B, 4, H, W), `scale` times the latent size, i.e. half of the image size by default. '''
+	factors = torch.tensor(latent_rgb_factors, device=latents.device, dtype=torch.float32)
+	rgb = torch.einsum("bchw,cr->bhwr", latents.float(), factors)
+	rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).byte().cpu().numpy()
+	return [
+		Image.fromarray(image).resize((image.shape[1] * scale, image.shape[0] * scale), resample=Image.BILINEAR)
+		for image in rgb
+	]
+
+
+####################################
+# Step callback
+####################################
+@contextmanager
+def step_callback(mode_pipe, callback, total_steps: int):
+	''' Call `callback(step, total_steps, latents)` after each denoising step of `mode_pipe` during the context.
+	The pipes of this diffusers version take no callback, so `step` of the current scheduler is
+	replaced on the instance. Use it inside `per_item_noise`, which swaps the scheduler. Does nothing if `callback` is None.
+	'''
+	if callback is None:
+		yield
+		return
+	scheduler = mode_pipe.scheduler
+	scheduler_step = scheduler.step
+	steps = {"done": 0}
+	# The pipes pass `eta` only if the signature of `step` has it, so the wrapper keeps the signature
+	@functools.wraps(scheduler_step)
+	def step_with_callback(*args, **kwargs):
+		output = scheduler_step(*args, **kwargs)
+		steps["done"] += 1
+		callback(steps["done"], total_steps, output[0] if isinstance(output, tuple) else output["prev_sample"])
+		return output
+	if "eta" in inspect.signature(scheduler_step).parameters and not "eta" in inspect.signature(step_with_callback).parameters:
+		raise RuntimeError(f"The step callback hides the eta argument of {type(scheduler).__name__}.step.")
+
+	with patch_attrs([(scheduler, "step", step_with_callback)]):
+		yield
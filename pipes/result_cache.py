@@ -0,0 +1,263 @@
+import io
+import os
+import os.path
+import json
+import inspect
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from pipes.batch import iter_predict_items
+from pipes.metrics import metrics
+
+
+####################################
+# Result cache
+####################################
+# Configured by environment variables:
+#   INPAINT_RESULT_CACHE_DIR: directory of the cached images. Default "./result_cache".
+#   INPAINT_RESULT_CACHE_MB: disk budget of the cached images, "0" disables the cache. Default "1024".
+# Arguments of the predict functions that do not change the image, or are keyed separately
+unkeyed_arguments = ["pipe", "prompt", "generator", "batch_size", "callback"]
+
+
+def image_fingerprint(image: Image.Image) -> str:
+	digest = hashlib.blake2b(image.tobytes(), digest_size=16)
+	digest.update(f"{image.mode}{image.size}".encode())
+	return digest.hexdigest()
+
+
+class ResultCache:
+	''' Generated images stored as PNG files in `cache_dir`, named by a hash of everything that determines them:
+	the model, the predict function and all its arguments (input images by fingerprint), the prompt and the seed of the image.
+	The least recently used files are deleted when they take more than `max_bytes`. Processes may share
+	the directory, each one only tracks the files it has seen, a file deleted by another one is a miss.
+	Files are written by a background thread, with the encoding of the shared PNG cache, so `put` does not
+	delay the next batch and an image saved elsewhere too is encoded once. `flush` waits for the writes.
+	'''
+	def __init__(self, cache_dir: str, model: str, max_bytes: int = 1024 * 1024 * 1024):
+		self.cache_dir = cache_dir
+		self.model = model
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._bytes = 0
+		self._entries = OrderedDict() # key => file size, least recently used first
+		self._lock = threading.Lock()
+		self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result_cache")
+		self._writes = []
+
+		os.makedirs(cache_dir, exist_ok=True)
+		files = []
+		for dir_entry in os.scandir(cache_dir):
+			if dir_entry.is_dir():
+				files += [entry for entry in os.scandir(dir_entry.path) if entry.name.endswith(".png")]
+		for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+			self._entries[entry.name[:-len(".png")]] = entry.stat().st_size
+			self._bytes += entry.stat().st_size
+		self._evict()
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				"entries": len(self._entries),
+				"bytes": self._bytes,
+			}
+
+	def _path(self, key: str) -> str:
+		return os.path.join(self.cache_dir, key[:2], key + ".png")
+
+	def params_key(self, predict_func, kwargs: dict) -> str:
+		''' Hash of the model, `predict_func` and its arguments in `kwargs`, with the defaults of those not given. '''
+		arguments = inspect.signature(predict_func).bind_partial(**kwargs)
+		arguments.apply_defaults()
+		params = {}
+		for name, value in arguments.arguments.items():
+			if name in unkeyed_arguments:
+				continue
+			params[name] = image_fingerprint(value) if isinstance(value, Image.Image) else value
+		# No sampler runs the default one
+		if "sampler" in params and params["sampler"] is None:
+			params["sampler"] = "ddim"
+		identity = json.dumps({
+			"model": self.model,
+			"func": f"{predict_func.__module__}.{predict_func.__qualname__}",
+			"params": params,
+		}, sort_keys=True, default=str)
+		return hashlib.sha256(identity.encode("utf8")).hexdigest()
+
+	def item_key(self, params_key: str, prompt: str, seed: int) -> str:
+		identity = json.dumps([params_key, prompt, seed])
+		return hashlib.sha256(identity.encode("utf8")).hexdigest()[:32]
+
+	def contains(self, key: str) -> bool:
+		''' Whether `key` is cached, without reading it. Counts a miss if not, a hit is counted by `get`. '''
+		with self._lock:
+			if key in self._entries:
+				return True
+			self.misses += 1
+			return False
+
+	def get(self, key: str) -> Image.Image:
+		from png_cache import shared_png_cache
+		with self._lock:
+			if not key in self._entries:
+				self.misses += 1
+				return None
+		path = self._path(key)
+		try:
+			with metrics.span("result_cache_get"):
+				with open(path, "rb") as f:
+					png_bytes = f.read()
+				with Image.open(io.BytesIO(png_bytes)) as image:
+					image.load()
+			os.utime(path)
+			# Saving the image again reuses the file
+			shared_png_cache().add(image, png_bytes)
+		except OSError:
+			with self._lock:
+				self.misses += 1
+				size = self._entries.pop(key, None)
+				if not size is None:
+					self._bytes -= size
+			return None
+		with self._lock:
+			self.hits += 1
+			if key in self._entries:
+				self._entries.move_to_end(key)
+		return image
+
+	def put(self, key: str, image: Image.Image):
+		''' Queue `image` to be written, it must not be modified afterwards. '''
+		with self._lock:
+			self._writes = [write for write in self._writes if not write.done()]
+			self._writes.append(self._writer.submit(self._write, key, image))
+
+	def flush(self):
+		''' Wait until the queued images are written. '''
+		with self._lock:
+			writes, self._writes = self._writes, []
+		for write in writes:
+			write.result()
+
+	def _write(self, key: str, image: Image.Image):
+		from png_cache import shared_png_cache
+		path = self._path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		# Write under another name first, so other processes never read a partial file
+		with metrics.span("result_cache_put"):
+			png_bytes = shared_png_cache().encode(image)
+			with open(path + ".tmp", "wb") as f:
+				f.write(png_bytes)
+		os.replace(path + ".tmp", path)
+		with self._lock:
+			self._bytes += len(png_bytes) - self._entries.pop(key, 0)
+			self._entries[key] = len(png_bytes)
+		self._evict()
+
+	def _evict(self):
+		while True:
+			with self._lock:
+				if self._bytes <= self.max_bytes or len(self._entries) == 0:
+					return
+				key, size = self._entries.popitem(last=False)
+				self._bytes -= size
+				self.evictions += 1
+			try:
+				os.remove(self._path(key))
+			except OSError:
+				pass
+
+
+def result_cache_from_env(model: str) -> ResultCache:
+	''' The result cache configured by environment variables, None if disabled. '''
+	max_bytes = int(os.environ.get("INPAINT_RESULT_CACHE_MB", 1024)) * 1024 * 1024
+	if max_bytes <= 0:
+		return None
+	cache = ResultCache(os.environ.get("INPAINT_RESULT_CACHE_DIR", "./result_cache"), model, max_bytes)
+	metrics.gauge("inpaint_result_cache_hits", lambda: cache.stats()["hits"])
+	metrics.gauge("inpaint_result_cache_misses", lambda: cache.stats()["misses"])
+	metrics.gauge("inpaint_result_cache_bytes", lambda: cache.stats()["bytes"])
+	return cache
+
+
+####################################
+# Cached predicting
+####################################
+def iter_cached_items(cache: ResultCache, params_key: str, predict_func, prompts: list, generators: list, max_batch_size: int, **kwargs):
+	''' Same as `iter_predict_items`, but images found in `cache` are not generated again.
+	The seed of an image is the initial seed of its generator, so each image needs its own generator,
+	see `pipes.noise.image_generators`. Otherwise, or if `cache` is None, nothing is cached.
+	Yields lists of images in the order of the items, None for images the predict function did not return.
+	Items are looked up a batch of misses ahead and cached images are read when they are yielded, at most
+	`max_batch_size` at a time, so memory does not grow with the number of items.
+	Generated images are put in `cache` after their list is consumed, so that an encoding done by
+	the consumer, through the shared PNG cache, is reused for the cache file.
+	'''
+	if cache is None or len(set(map(id, generators))) < len(generators):
+		yield from iter_predict_items(predict_func, prompts, generators, max_batch_size, **kwargs)
+		return
+
+	keys = [cache.item_key(params_key, prompt, generator.initial_seed()) for prompt, generator in zip(prompts, generators)]
+	done = 0 # items yielded
+
+	def predict(indices: list):
+		return iter_predict_items(predict_func, [prompts[i] for i in indices], [generators[i] for i in indices], max_batch_size, **kwargs)
+
+	def yield_put(images: list, indices: list, generated: list):
+		''' Yield `images` of the items at `indices`, then put those at `generated` in the cache. '''
+		if len(images) == 0:
+			return
+		yield images
+		for i, image in zip(indices, images):
+			if i in generated and not image is None:
+				cache.put(keys[i], image)
+
+	def iter_hits(end: int):
+		''' Yield the cached images of the items from `done` to `end`. '''
+		nonlocal done
+		while done < end:
+			indices = list(range(done, min(end, done + max_batch_size)))
+			images = [cache.get(keys[i]) for i in indices]
+			done = indices[-1] + 1
+			# Deleted by another process since the lookup
+			lost = [i for i, image in zip(indices, images) if image is None]
+			if len(lost) > 0:
+				regenerated = iter([image for batch in predict(lost) for image in batch])
+				images = [next(regenerated) if image is None else image for image in images]
+			yield from yield_put(images, indices, lost)
+
+	def generate(misses: list):
+		''' Yield the images of the items from `done` to the last of `misses`, generating those at `misses`. '''
+		nonlocal done
+		generated = 0
+		for batch in predict(misses):
+			images, indices = [], []
+			for image in batch:
+				i = misses[generated]
+				generated += 1
+				if done < i:
+					# Cached items come first
+					yield from yield_put(images, indices, indices)
+					images, indices = [], []
+					yield from iter_hits(i)
+				images.append(image)
+				indices.append(i)
+				done = i + 1
+			yield from yield_put(images, indices, indices)
+
+	misses = []
+	for i, key in enumerate(keys):
+		if not cache.contains(key):
+			misses.append(i)
+		if len(misses) == max_batch_size:
+			yield from generate(misses)
+			misses = []
+	if len(misses) > 0:
+		yield from generate(misses)
+	yield from iter_hits(len(keys))
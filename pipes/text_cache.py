@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+import torch
+from pipes.metrics import metrics
+
+
+####################################
+# Cached text encoder
+####################################
+class CachedTextEncoder(torch.nn.Module):
+	''' Wraps the CLIP text encoder to cache the embedding of each prompt.
+	The pipes encode the conditional and the unconditional ("") prompts by calling
+	`text_encoder(input_ids)[0]`, so each row of `input_ids` is looked up in an LRU cache
+	keyed by (model_id, token ids) and only the missing rows are encoded.
+	Token ids already identify the tokenizer's output for a prompt, so every mode and session
+	sharing this encoder shares the cache.
+	The cache is bounded by `max_bytes` of embeddings.
+	'''
+	def __init__(self, text_encoder, model_id: str, max_bytes: int = 64 * 1024 * 1024):
+		super().__init__()
+		self.text_encoder = text_encoder
+		self.model_id = model_id
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self._bytes = 0
+		self._cache = OrderedDict() # key => embedding of one prompt, least recently used first
+		self._lock = threading.Lock()
+
+	@property
+	def device(self):
+		return self.text_encoder.device
+
+	@property
+	def dtype(self):
+		return self.text_encoder.dtype
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"entries": len(self._cache),
+				"bytes": self._bytes,
+			}
+
+	def clear(self):
+		with self._lock:
+			self._cache.clear()
+			self._bytes = 0
+
+	def _get(self, key):
+		with self._lock:
+			embedding = self._cache.get(key)
+			if embedding is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self._cache.move_to_end(key)
+			return embedding
+
+	def _put(self, key, embedding):
+		size = embedding.numel() * embedding.element_size()
+		if size > self.max_bytes:
+			return
+		with self._lock:
+			if key in self._cache:
+				return
+			self._cache[key] = embedding
+			self._bytes += size
+			while self._bytes > self.max_bytes:
+				_, evicted = self._cache.popitem(last=False)
+				self._bytes -= evicted.numel() * evicted.element_size()
+
+	def forward(self, input_ids, **kwargs):
+		if len(kwargs) > 0:
+			return self.text_encoder(input_ids, **kwargs)
+
+		keys = [(self.model_id, tuple(row)) for row in input_ids.tolist()]
+		embeddings = [self._get(key) for key in keys]
+
+		# Encode the missing prompts in one batch, once each
+		missing = list(OrderedDict.fromkeys(key for key, embedding in zip(keys, embeddings) if embedding is None))
+		if len(missing) > 0:
+			missing_ids = torch.tensor([key[1] for key in missing], dtype=input_ids.dtype, device=input_ids.device)
+			with torch.no_grad(), metrics.span("text_encode"):
+				encoded = self.text_encoder(missing_ids)[0]
+			# Clone rows, a view would keep the whole batch alive in the cache
+			encoded = dict(zip(missing, (embedding.clone() for embedding in encoded)))
+			for key, embedding in encoded.items():
+				self._put(key, embedding)
+			embeddings = [encoded[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+
+		return (torch.stack(embeddings),)
@@ -0,0 +1,110 @@
+import torch
+from contextlib import contextmanager
+from pipes.patch import patch_attrs
+
+
+####################################
+# Tiled apply
+####################################
+def tile_starts(length: int, tile: int, overlap: int) -> list:
+	if length <= tile:
+		return [0]
+	starts = list(range(0, length - tile, tile - overlap))
+	starts.append(length - tile)
+	return starts
+
+def tile_weight(height: int, width: int, ramp: int, device) -> torch.Tensor:
+	''' Weight of a tile's output, ramping up over `ramp` pixels from each edge. '''
+	def ramp_1d(length):
+		i = torch.arange(length, device=device, dtype=torch.float32)
+		return torch.minimum(torch.minimum((i + 1) / (ramp + 1), (length - i) / (ramp + 1)), torch.ones_like(i))
+	return ramp_1d(height)[:, None] * ramp_1d(width)[None, :]
+
+def tiled_apply(func, x: torch.Tensor, tile: int, overlap: int, scale: float) -> torch.Tensor:
+	''' Apply `func` to overlapping `tile`x`tile` tiles of `x` (B, C, H, W) and blend the outputs.
+	`func` maps a tile of size (h, w) to a tile of size (h*scale, w*scale).
+	Overlapping outputs are averaged with weights ramping over the overlap, so seams fade out.
+	Peak memory of `func` is bounded by the tile size instead of the size of `x`.
+	'''
+	height, width = x.shape[-2:]
+	out = None
+	weight_sum = None
+	for top in tile_starts(height, tile, overlap):
+		for left in tile_starts(width, tile, overlap):
+			y = func(x[..., top:top+tile, left:left+tile])
+			out_top, out_left = int(top * scale), int(left * scale)
+			out_height, out_width = y.shape[-2:]
+			if out is None:
+				out = torch.zeros((*y.shape[:-2], int(height * scale), int(width * scale)), device=y.device, dtype=torch.float32)
+				weight_sum = torch.zeros((int(height * scale), int(width * scale)), device=y.device, dtype=torch.float32)
+			weight = tile_weight(out_height, out_width, int(overlap * scale), y.device)
+			out[..., out_top:out_top+out_height, out_left:out_left+out_width] += y.float() * weight
+			weight_sum[out_top:out_top+out_height, out_left:out_left+out_width] += weight
+	return (out / weight_sum).to(y.dtype)
+
+
+####################################
+# Tiled pipe
+####################################
+@contextmanager
+def tiled(mode_pipe, tile_size: int, tile_overlap: int = 64):
+	''' Run the unet and the vae of `mode_pipe` tile by tile during the context.
+	`tile_size` and `tile_overlap` are in pixels, the unet works on latents, which are 8 times smaller.
+	Both are rounded down to multiples of 64 pixels, the overlap to at most half a tile.
+	The forward/encode/decode methods are replaced on the instances, so the caller must hold the
+	registry's lock. Does nothing if `tile_size` is None.
+	'''
+	if tile_size is None:
+		yield
+		return
+	# The unet downsamples latents 3 times, so latent tiles and their strides must be multiples of 8,
+	# i.e. 64 pixels
+	tile_size = max(64, tile_size - tile_size % 64)
+	max_overlap = tile_size // 2 - (tile_size // 2) % 64
+	tile_overlap = max(0, min(tile_overlap - tile_overlap % 64, max_overlap))
+	latent_tile, latent_overlap = tile_size // 8, tile_overlap // 8
+
+	unet, vae = mode_pipe.unet, mode_pipe.vae
+	unet_forward, vae_encode, vae_decode = unet.forward, vae.encode, vae.decode
+
+	def tiled_unet_forward(sample, timestep, encoder_hidden_states, **kwargs):
+		output = {}
+		def func(tile):
+			output["last"] = unet_forward(tile, timestep, encoder_hidden_states=encoder_hidden_states, **kwargs)
+			return output["last"][0] if isinstance(output["last"], tuple) else output["last"]["sample"]
+		noise_pred = tiled_apply(func, sample, latent_tile, latent_overlap, 1)
+		if isinstance(output["last"], tuple):
+			return (noise_pred,)
+		return type(output["last"])(sample=noise_pred)
+
+	def tiled_vae_decode(z, **kwargs):
+		output = {}
+		def func(tile):
+			output["last"] = vae_decode(tile, **kwargs)
+			return output["last"][0] if isinstance(output["last"], tuple) else output["last"]["sample"]
+		image = tiled_apply(func, z, latent_tile, latent_overlap, 8)
+		if isinstance(output["last"], tuple):
+			return (image,)
+		return type(output["last"])(sample=image)
+
+	def tiled_vae_encode(x, **kwargs):
+		# Blend the parameters (mean & logvar) of the latent distribution of each tile
+		output = {}
+		def func(tile):
+			output["last"] = vae_encode(tile, **kwargs)
+			latent_dist = output["last"][0] if isinstance(output["last"], tuple) else output["last"]["latent_dist"]
+			return latent_dist.parameters
+		parameters = tiled_apply(func, x, tile_size, tile_overlap, 1 / 8)
+		latent_dist = output["last"][0] if isinstance(output["last"], tuple) else output["last"]["latent_dist"]
+		latent_dist = type(latent_dist)(parameters)
+		if isinstance(output["last"], tuple):
+			return (latent_dist,)
+		return type(output["last"])(latent_dist=latent_dist)
+
+	patches = [
+		(unet, "forward", tiled_unet_forward),
+		(vae, "encode", tiled_vae_encode),
+		(vae, "decode", tiled_vae_decode),
+	]
+	with patch_attrs(patches):
+		yield
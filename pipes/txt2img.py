@@ -1,15 +1,19 @@
 import torch
 import PIL
-from diffusers import StableDiffusionPipeline
+from pipes.backend import backend
+from pipes.tiling import tiled
+from pipes.preview import step_callback
+from pipes.noise import per_item_latents
 
 
 ####################################
 # Interface for predicting
 ####################################
-def predict(prompt: str, height: int, width: int, num_inference_steps: int, guidance_scale: float, eta: float, generator: torch.Generator, pipe=None, **kwargs) -> PIL.Image:
+def predict(prompt: str, height: int, width: int, num_inference_steps: int, guidance_scale: float, eta: float, generator, pipe=None, batch_size: int = 1, tile_size: int = None, tile_overlap: int = 64, memory_profile: str = None, sampler: str = None, callback=None, **kwargs) -> list:
 	''' Args (copied from StableDiffusionPipeline.__call__):
 		prompt (`str` or `List[str]`):
 			The prompt or prompts to guide the image generation.
+			A `str` is shared by the whole batch, a `List[str]` gives the prompt of each image.
 		height (`int`, *optional*, defaults to 512):
 			The height in pixels of the generated image.
 		width (`int`, *optional*, defaults to 512):
@@ -27,9 +31,10 @@ def predict(prompt: str, height: int, width: int, num_inference_steps: int, guid
 			Corresponds to parameter eta (η) in the DDIM paper: https://arxiv.org/abs/2010.02502. Only applies to
 			[`schedulers.DDIMScheduler`], will be ignored for others.
 			This includes an original DDPM generative process when η = 1 and DDIM when η = 0.
-		generator (`torch.Generator`, *optional*):
+		generator (`torch.Generator` or `List[torch.Generator]`, *optional*):
 			A [torch generator](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make generation
 			deterministic.
+			Can also be a list of generators, one per image, the noise of each image is then drawn from its own generator.
 		latents (`torch.FloatTensor`, *optional*):
 			Pre-generated noisy latents, sampled from a Gaussian distribution, to be used as inputs for image
 			generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
@@ -40,17 +45,34 @@ def predict(prompt: str, height: int, width: int, num_inference_steps: int, guid
 		return_dict (`bool`, *optional*, defaults to `True`):
 			Whether or not to return a [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] instead of a
 			plain tuple.
-	'''
-	pipe.__class__ = StableDiffusionPipeline
+		pipe (`PipeRegistry`):
+			The registry from `pipes.get_pipe`. The "txt2img" pipeline is run while holding its lock.
+		batch_size (`int`, *optional*, defaults to 1):
+			How many images are generated in one batched denoising loop.
+		tile_size (`int`, *optional*, defaults to None):
+			If set, the unet and the vae work on overlapping tiles of `tile_size` pixels whose seams are blended,
+			so peak memory is bounded by the tile size instead of the image size. `tile_overlap` is in pixels too.
+		memory_profile (`str`, *optional*, defaults to None):
+			"fast", "balanced" or "low-memory", see `pipes.memory.profiles`. None keeps the current profile.
+		sampler (`str`, *optional*, defaults to None):
+			"ddim", "pndm", "lms" or "dpm-solver", see `pipes.samplers`. None means "ddim".
+		callback (`Callable[[int, int, torch.FloatTensor], None]`, *optional*):
+			Called after each denoising step with (step, total steps, latents), see `pipes.preview`.
+			Raise `pipes.preview.Cancelled` in it to stop the run.
 
-	with torch.autocast("cuda"):
-		image = pipe(
-			prompt, 
+	Returns a list of images, `batch_size` of them or one per prompt if `prompt` is a list.
+	'''
+	prompts = prompt if isinstance(prompt, list) else [prompt] * batch_size
+	with pipe.use("txt2img", len(prompts), memory_profile, sampler) as mode_pipe, tiled(mode_pipe, tile_size, tile_overlap), step_callback(mode_pipe, callback, num_inference_steps), backend.autocast():
+		latents, generator = per_item_latents(mode_pipe, generator, height, width)
+		images = mode_pipe(
+			prompts, 
 			height=height,
 			width=width, 
 			num_inference_steps=num_inference_steps, 
 			guidance_scale=guidance_scale, 
 			eta=eta, 
 			generator=generator,
-		)["images"][0]
-	return image
+			latents=latents,
+		)["images"]
+	return images
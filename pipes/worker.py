@@ -0,0 +1,308 @@
+import time
+import itertools
+import threading
+from collections import OrderedDict, deque
+from PIL import Image
+from pipes.result_cache import iter_cached_items
+from pipes.metrics import metrics
+
+
+class QueueFullError(Exception):
+	pass
+
+
+####################################
+# Job
+####################################
+class Job:
+	''' A request to generate `n` images with `func(pipe=..., batch_size=..., **kwargs)`.
+	`info` is kept for the submitter, e.g. the seed to record in metadata.
+	'''
+	def __init__(self, job_id: int, session_id: str, func, n: int, max_batch_size: int, kwargs: dict, info: dict):
+		self.job_id = job_id
+		self.session_id = session_id
+		self.func = func
+		self.n = n
+		self.max_batch_size = max_batch_size
+		self.kwargs = kwargs
+		self.info = info
+		# "queued", "running", "done", "failed" or "cancelled"
+		self.status = "queued"
+		self.images = []
+		self.error = None
+		self.cancel_requested = False
+		# Denoising step of the running batch and approximate previews of this job's images in it
+		self.step = 0
+		self.total_steps = 0
+		self.previews = []
+		self.submit_time = time.perf_counter()
+		self.start_time = None
+
+	def batch_key(self) -> tuple:
+		''' Jobs with equal keys can share batches, only their prompts and generators may differ. '''
+		key = [self.func]
+		for name, value in sorted(self.kwargs.items()):
+			if name in ["prompt", "generator"]:
+				continue
+			# Images are compared by identity, comparing pixels is too slow
+			key.append((name, id(value) if isinstance(value, Image.Image) else value))
+		return tuple(key)
+
+	def generators(self) -> list:
+		''' The generator of each image, the `generator` argument is either shared by all images or a list of one per image. '''
+		generator = self.kwargs["generator"]
+		return generator if isinstance(generator, list) else [generator] * self.n
+
+	@property
+	def progress(self) -> float:
+		return len(self.images) / self.n
+
+	@property
+	def finished(self) -> bool:
+		return self.status in ["done", "failed", "cancelled"]
+
+
+####################################
+# Worker stats
+####################################
+class WorkerStats:
+	''' Achieved batch sizes and the delays added by queueing and by waiting for jobs to coalesce. '''
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.jobs = 0
+		self.groups = 0
+		self.coalesced_jobs = 0
+		self.batches = 0
+		self.images = 0
+		self.max_batch_size = 0
+		self.queue_delay = 0.0
+		self.window_delay = 0.0
+
+	def record_group(self, group: list, window_delay: float):
+		with self._lock:
+			self.groups += 1
+			self.jobs += len(group)
+			if len(group) > 1:
+				self.coalesced_jobs += len(group)
+			self.queue_delay += sum(job.start_time - job.submit_time for job in group)
+			self.window_delay += window_delay
+
+	def record_batch(self, batch_size: int):
+		with self._lock:
+			self.batches += 1
+			self.images += batch_size
+			self.max_batch_size = max(self.max_batch_size, batch_size)
+
+	def summary(self) -> dict:
+		with self._lock:
+			return {
+				"jobs": self.jobs,
+				"coalesced_jobs": self.coalesced_jobs,
+				"batches": self.batches,
+				"images": self.images,
+				"mean_batch_size": self.images / self.batches if self.batches else 0.0,
+				"max_batch_size": self.max_batch_size,
+				"mean_queue_delay": self.queue_delay / self.jobs if self.jobs else 0.0,
+				"mean_window_delay": self.window_delay / self.groups if self.groups else 0.0,
+			}
+
+
+####################################
+# Worker
+####################################
+class GenerationWorker:
+	''' Owns the pipe and runs jobs from all sessions one by one in a background thread.
+	Sessions take turns: each time the next job is picked from the next session in round robin,
+	so that a session submitting many jobs does not starve the others.
+	After picking a job, the worker waits up to `batch_window` seconds for compatible jobs from
+	other sessions (see `Job.batch_key`) and runs them together in shared batches.
+	Running jobs get approximate previews every `preview_every` denoising steps.
+	'''
+	def __init__(self, lazy_pipe, max_queue_depth: int = 16, batch_window: float = 0.1, preview_every: int = 5):
+		self.lazy_pipe = lazy_pipe
+		self.max_queue_depth = max_queue_depth
+		self.batch_window = batch_window
+		self.preview_every = preview_every
+		self.stats = WorkerStats()
+		self._queues = OrderedDict() # session_id => deque of queued jobs, in turn order
+		self._jobs = {} # job_id => job, until removed by its submitter
+		self._job_ids = itertools.count()
+		self._cond = threading.Condition()
+		self._thread = threading.Thread(target=self._run, name="generation_worker", daemon=True)
+		self._thread.start()
+		metrics.gauge("inpaint_queue_depth", self.queue_depth)
+
+	def queue_depth(self) -> int:
+		with self._cond:
+			return sum(len(queue) for queue in self._queues.values())
+
+	def submit(self, session_id: str, func, n: int, max_batch_size: int, info: dict = None, **kwargs) -> Job:
+		with self._cond:
+			if self.queue_depth() >= self.max_queue_depth:
+				raise QueueFullError(f"There are already {self.max_queue_depth} jobs queued.")
+			job = Job(next(self._job_ids), session_id, func, n, max_batch_size, kwargs, info or {})
+			self._jobs[job.job_id] = job
+			self._queues.setdefault(session_id, deque()).append(job)
+			self._cond.notify()
+			return job
+
+	def get(self, job_id: int) -> Job:
+		with self._cond:
+			return self._jobs.get(job_id)
+
+	def remove(self, job_id: int):
+		''' Forget a finished job, so that its images can be freed. '''
+		with self._cond:
+			job = self._jobs.get(job_id)
+			if not job is None and job.finished:
+				del self._jobs[job_id]
+
+	def cancel(self, job_id: int):
+		''' A queued job is dropped, a running one stops at its next denoising step and keeps the images done so far.
+		Batches shared with other jobs keep running for them.
+		'''
+		with self._cond:
+			job = self._jobs.get(job_id)
+			if job is None or job.finished:
+				return
+			job.cancel_requested = True
+			queue = self._queues.get(job.session_id)
+			if not queue is None and job in queue:
+				queue.remove(job)
+				if len(queue) == 0:
+					del self._queues[job.session_id]
+				job.status = "cancelled"
+				metrics.inc("inpaint_jobs_total", status=job.status)
+
+	def position(self, job: Job) -> int:
+		''' How many queued jobs will run before `job`. '''
+		with self._cond:
+			queues = [list(queue) for queue in self._queues.values()]
+		position = 0
+		for turn in range(max((len(queue) for queue in queues), default=0)):
+			for queue in queues:
+				if turn < len(queue):
+					if queue[turn] is job:
+						return position
+					position += 1
+		return 0
+
+	def _pop_job(self, session_id: str) -> Job:
+		queue = self._queues.pop(session_id)
+		job = queue.popleft()
+		if len(queue) > 0:
+			# Move to the end of the turn order
+			self._queues[session_id] = queue
+		return job
+
+	def _take_compatible(self, group: list):
+		''' Add to `group` the compatible job at the head of each other session's queue. '''
+		key = group[0].batch_key()
+		max_batch_size = min(job.max_batch_size for job in group)
+		for session_id, queue in list(self._queues.items()):
+			if sum(job.n for job in group) >= max_batch_size:
+				break
+			if any(job.session_id == session_id for job in group):
+				continue
+			if queue[0].batch_key() == key:
+				group.append(self._pop_job(session_id))
+
+	def _next_group(self) -> list:
+		with self._cond:
+			while len(self._queues) == 0:
+				self._cond.wait()
+			group = [self._pop_job(next(iter(self._queues)))]
+
+			window_start = time.perf_counter()
+			deadline = window_start + self.batch_window
+			while True:
+				self._take_compatible(group)
+				remaining = deadline - time.perf_counter()
+				if remaining <= 0 or sum(job.n for job in group) >= group[0].max_batch_size:
+					break
+				self._cond.wait(remaining)
+
+			now = time.perf_counter()
+			for job in group:
+				job.status = "running"
+				job.start_time = now
+				metrics.observe("inpaint_queue_wait_seconds", now - job.submit_time)
+			self.stats.record_group(group, now - window_start)
+			return group
+
+	def _step_callback(self, batch_jobs: list):
+		''' Callback for the denoising steps of a batch whose i-th image belongs to `batch_jobs[i]`. '''
+		from pipes.preview import Cancelled, latents_to_previews
+		jobs = list(set(batch_jobs))
+		def callback(step, total_steps, latents):
+			if all(job.cancel_requested for job in jobs):
+				raise Cancelled()
+			previews = None
+			if step % self.preview_every == 0 or step == total_steps:
+				previews = latents_to_previews(latents)
+			for job in jobs:
+				job.step, job.total_steps = step, total_steps
+				if not previews is None:
+					job.previews = [preview for item_job, preview in zip(batch_jobs, previews) if item_job is job]
+		return callback
+
+	def _predict_func(self, group: list):
+		''' Wraps the predict function of `group` to report steps, record the batches the pipe runs and stop batches whose jobs are all cancelled.
+		A stopped batch yields None for each of its images.
+		'''
+		from pipes.preview import Cancelled
+		job_of_generator = {id(generator): job for job in group for generator in job.generators()}
+		func = group[0].func
+		def predict(batch_size, **kwargs):
+			generators = kwargs["generator"] if isinstance(kwargs["generator"], list) else [kwargs["generator"]] * batch_size
+			batch_jobs = [job_of_generator[id(generator)] for generator in generators]
+			try:
+				if all(job.cancel_requested for job in batch_jobs):
+					raise Cancelled()
+				images = func(batch_size=batch_size, callback=self._step_callback(batch_jobs), **kwargs)
+			except Cancelled:
+				return [None] * batch_size
+			# Only batches the pipe ran, images read from the result cache are not batches
+			self.stats.record_batch(batch_size)
+			return images
+		return predict
+
+	def _run_group(self, group: list):
+		pipe = self.lazy_pipe.get()
+		func = self._predict_func(group)
+
+		# Interleave the images of the jobs, so that every batch serves all of them
+		items = [] # (job, generator) of each image
+		for i in range(max(job.n for job in group)):
+			items += [(job, job.generators()[i]) for job in group if i < job.n]
+		kwargs = {name: value for name, value in group[0].kwargs.items() if not name in ["prompt", "generator"]}
+		# Images already generated with the same model, arguments and seed are read from the result cache
+		params_key = None if pipe.result_cache is None else pipe.result_cache.params_key(group[0].func, kwargs)
+		done = 0
+		for images in iter_cached_items(pipe.result_cache, params_key, func,
+			[job.kwargs["prompt"] for job, _ in items],
+			[generator for _, generator in items],
+			min(job.max_batch_size for job in group),
+			pipe=pipe,
+			**kwargs
+		):
+			for image in images:
+				if not image is None:
+					items[done][0].images.append(image)
+				done += 1
+
+	def _run(self):
+		while True:
+			group = self._next_group()
+			try:
+				with metrics.span("job"):
+					self._run_group(group)
+				for job in group:
+					job.status = "cancelled" if job.cancel_requested else "done"
+			except Exception as e:
+				print(f"Jobs {[job.job_id for job in group]} failed: {e!r}")
+				for job in group:
+					job.error = e
+					job.status = "failed"
+			for job in group:
+				metrics.inc("inpaint_jobs_total", status=job.status)
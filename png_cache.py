@@ -0,0 +1,124 @@
+import io
+import os
+import zlib
+import struct
+import hashlib
+import weakref
+import threading
+from collections import OrderedDict
+
+
+def encode_png(image) -> bytes:
+	from pipes.metrics import metrics
+	with metrics.span("png_encode"):
+		image_buf = io.BytesIO()
+		image.save(image_buf, format="png")
+		return image_buf.getvalue()
+
+def add_png_text(png_bytes: bytes, keyword: str, text: str) -> bytes:
+	''' Insert a tEXt chunk before IEND, same as PngInfo.add_text but without re-encoding the image. '''
+	data = keyword.encode("latin-1") + b"\0" + text.encode("latin-1")
+	chunk = struct.pack(">I", len(data)) + b"tEXt" + data + struct.pack(">I", zlib.crc32(b"tEXt" + data) & 0xffffffff)
+	# IEND is always the last 12 bytes
+	return png_bytes[:-12] + chunk + png_bytes[-12:]
+
+
+####################################
+# PNG cache
+####################################
+class PngCache:
+	''' Encoded PNG bytes of images, so that each image is encoded at most once.
+	An image is looked up by identity first, a new image object is looked up by a digest of its
+	pixels, which is much cheaper than encoding it. Images must not be modified in place after
+	being encoded.
+	Least recently used entries are evicted when the cache holds more than `max_bytes`.
+	'''
+	def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self._bytes = 0
+		self._entries = OrderedDict() # digest => png bytes, least recently used first
+		self._digests = {} # id(image) => (weakref of image, digest)
+		# Reentrant, the weakref callback may run during garbage collection while the lock is held
+		self._lock = threading.RLock()
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"entries": len(self._entries),
+				"bytes": self._bytes,
+			}
+
+	def _digest(self, image) -> str:
+		image_id = id(image)
+		with self._lock:
+			ref_digest = self._digests.get(image_id)
+		if not ref_digest is None and ref_digest[0]() is image:
+			return ref_digest[1]
+
+		digest = hashlib.blake2b(image.tobytes(), digest_size=16)
+		digest.update(f"{image.mode}{image.size}".encode())
+		digest = digest.hexdigest()
+		def forget(_):
+			with self._lock:
+				self._digests.pop(image_id, None)
+		with self._lock:
+			self._digests[image_id] = (weakref.ref(image, forget), digest)
+		return digest
+
+	def encode(self, image) -> bytes:
+		digest = self._digest(image)
+		with self._lock:
+			png_bytes = self._entries.get(digest)
+			if not png_bytes is None:
+				self.hits += 1
+				self._entries.move_to_end(digest)
+				return png_bytes
+			self.misses += 1
+
+		png_bytes = encode_png(image)
+		if len(png_bytes) > self.max_bytes:
+			return png_bytes
+		with self._lock:
+			if not digest in self._entries:
+				self._entries[digest] = png_bytes
+				self._bytes += len(png_bytes)
+			while self._bytes > self.max_bytes:
+				_, evicted = self._entries.popitem(last=False)
+				self._bytes -= len(evicted)
+		return png_bytes
+
+	def add(self, image, png_bytes: bytes):
+		''' Remember `png_bytes` as the encoding of `image`, e.g. when the image was decoded from them. '''
+		if len(png_bytes) > self.max_bytes:
+			return
+		digest = self._digest(image)
+		with self._lock:
+			if not digest in self._entries:
+				self._entries[digest] = png_bytes
+				self._bytes += len(png_bytes)
+			self._entries.move_to_end(digest)
+			while self._bytes > self.max_bytes:
+				_, evicted = self._entries.popitem(last=False)
+				self._bytes -= len(evicted)
+
+	def encode_with_text(self, image, keyword: str, text: str) -> bytes:
+		''' PNG bytes with a tEXt chunk, reusing the cached encoding of the image. '''
+		return add_png_text(self.encode(image), keyword, text)
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def shared_png_cache() -> PngCache:
+	''' The PNG cache of the process, shared by the GUI, the CLI and the result cache so that an image
+	saved in several places is still encoded once. Its budget is INPAINT_PNG_CACHE_MB, default 256.
+	'''
+	global _shared_cache
+	with _shared_cache_lock:
+		if _shared_cache is None:
+			_shared_cache = PngCache(max_bytes=int(os.environ.get("INPAINT_PNG_CACHE_MB", 256)) * 1024 * 1024)
+		return _shared_cache
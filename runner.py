@@ -0,0 +1,288 @@
+import os
+import os.path
+import sys
+import json
+import time
+import hashlib
+import datetime
+
+
+modes = ["txt2img", "inpaint", "img2img"]
+
+# Config keys passed to the predict functions
+predict_keys = ["prompt", "height", "width", "keep_origin", "crop_to_mask", "crop_padding", "crop_resolution", "tile_size", "tile_overlap", "memory_profile", "sampler", "strength", "num_inference_steps", "guidance_scale", "eta"]
+
+
+def random_filename():
+	import uuid
+	return str(uuid.uuid4())
+
+def load_configs(filepath: str):
+	''' Yield the configs of a config file, either a JSON list, or JSON lines (.jsonl) read line by line.
+	`filepath` "-" reads JSON lines from stdin.
+	'''
+	if filepath == "-":
+		for line in sys.stdin:
+			if line.strip() != "":
+				yield json.loads(line)
+		return
+	with open(filepath, mode="r", encoding="utf8") as f:
+		if filepath.endswith(".jsonl"):
+			for line in f:
+				if line.strip() != "":
+					yield json.loads(line)
+		else:
+			yield from json.load(f)
+
+def get_predict_func(mode: str):
+	import importlib
+	return importlib.import_module(f"pipes.{mode}").predict
+
+def config_key(config: dict, mode: str, image_paths: list) -> str:
+	''' Identifies a config run in a mode on some input images, for the manifest. '''
+	identity = json.dumps({"config": config, "mode": mode, "images": image_paths}, sort_keys=True)
+	return hashlib.sha256(identity.encode("utf8")).hexdigest()[:16]
+
+def image_config(png_path: str) -> tuple:
+	''' (config, mode, index) of an image saved by `run_config`, from its "stable diffusion" text chunk. '''
+	import PIL.Image
+	with PIL.Image.open(png_path) as image:
+		config = json.loads(image.text["stable diffusion"])
+	if not "index" in config:
+		raise ValueError(f"{png_path} has no image index, it was generated before images had their own seeds.")
+	config.pop("image_seed", None)
+	return config, config.pop("mode"), config.pop("index")
+
+def remaining_indices(config: dict, mode: str, image_paths: list, manifest = None) -> list:
+	''' Indices of the images of `config` not recorded in `manifest`. '''
+	key = config_key(config, mode, image_paths)
+	return [i for i in range(config["n"]) if manifest is None or not manifest.is_done(key, i)]
+
+
+####################################
+# Manifest
+####################################
+class Manifest:
+	''' Records each generated image as a (config key, index) JSON line, so that a restarted
+	run skips images that are already generated. The random seed chosen for a config without one
+	is recorded as well, so that a restarted run continues with the same seed.
+	'''
+	def __init__(self, path: str):
+		self.path = path
+		self.done = {} # (config key, index) => filepath
+		self.seeds = {} # config key => seed
+		if os.path.exists(path):
+			with open(path, mode="r", encoding="utf8") as f:
+				for line in f:
+					if line.strip() == "":
+						continue
+					record = json.loads(line)
+					if "seed" in record:
+						self.seeds[record["config"]] = record["seed"]
+					else:
+						self.done[(record["config"], record["index"])] = record["file"]
+
+	def is_done(self, key: str, index: int) -> bool:
+		return (key, index) in self.done
+
+	def _append(self, record: dict):
+		with open(self.path, mode="a", encoding="utf8") as f:
+			f.write(json.dumps(record) + "\n")
+			f.flush()
+
+	def record(self, key: str, index: int, filepath: str):
+		self.done[(key, index)] = filepath
+		self._append({"config": key, "index": index, "file": filepath})
+
+	def record_seed(self, key: str, seed: str):
+		self.seeds[key] = seed
+		self._append({"config": key, "seed": seed})
+
+
+####################################
+# Progress
+####################################
+class Progress:
+	''' Throughput & ETA over `total` images, only throughput if `total` is None. '''
+	def __init__(self, total: int):
+		self.total = total
+		self.done = 0
+		self.start = time.perf_counter()
+
+	def update(self, count: int = 1) -> str:
+		self.done += count
+		elapsed = time.perf_counter() - self.start
+		rate = self.done / elapsed if elapsed > 0 else 0.0
+		if self.total is None:
+			return f"{self.done} images, {rate:.2f} images/s"
+		eta = (self.total - self.done) / rate if rate > 0 else 0.0
+		return f"{self.done}/{self.total} images, {rate:.2f} images/s, ETA {datetime.timedelta(seconds=round(eta))}"
+
+
+####################################
+# Run configs
+####################################
+def seeded(config: dict, manifest: Manifest = None, key: str = None) -> dict:
+	''' A copy of `config` with a random seed if it has none. The seed is recorded in `manifest`
+	under the config `key`, and the recorded one is reused when the run is restarted.
+	'''
+	config = dict(config)
+	if config["seed"] is None:
+		if not manifest is None and key in manifest.seeds:
+			config["seed"] = manifest.seeds[key]
+		else:
+			from pipes.backend import backend
+			config["seed"] = str(backend.generator().seed())
+			if not manifest is None:
+				manifest.record_seed(key, config["seed"])
+	return config
+
+class ConfigRun:
+	''' The images `indices` of a config to generate in a mode, and how to save them into `out_dir`.
+	`kwargs` holds the arguments not in the config, like init_image. `key` identifies the config in the manifest,
+	by default it is computed from `config`, pass it when `config` was seeded by the caller.
+	A random seed of `config` is kept in `manifest`, see `seeded`.
+	'''
+	def __init__(self, config: dict, mode: str, kwargs: dict, out_dir: str, image_paths: list, indices: list, key: str = None, manifest: Manifest = None):
+		from pipes.noise import image_generators
+		self.key = config_key(config, mode, image_paths) if key is None else key
+		self.config = seeded(config, manifest, self.key)
+		self.mode = mode
+		self.out_dir = out_dir
+		self.indices = indices
+		# Each image gets its own generator seeded from the seed and its index,
+		# so an image is the same whichever batch it is generated in
+		self.generators = image_generators(self.config["seed"], indices)
+		self.kwargs = dict(kwargs)
+		for key_name in predict_keys:
+			if key_name in self.config.keys() and not key_name in self.kwargs:
+				self.kwargs[key_name] = self.config[key_name]
+		self.prompt = self.kwargs.pop("prompt")
+		self.max_batch_size = self.config.get("max_batch_size", 1)
+
+	def batch_key(self) -> tuple:
+		''' Runs with equal keys can share batches, only their prompts and seeds may differ. '''
+		import PIL.Image
+		key = [self.mode, self.max_batch_size]
+		for name, value in sorted(self.kwargs.items()):
+			# Images are compared by identity, comparing pixels is too slow
+			key.append((name, id(value) if isinstance(value, PIL.Image.Image) else value))
+		return tuple(key)
+
+	def png_metadata(self, index: int) -> str:
+		''' The config, the mode, the index and the seed of the image, enough to regenerate it alone. '''
+		from pipes.noise import image_seed
+		return json.dumps({**self.config, "mode": self.mode, "index": index, "image_seed": image_seed(self.config["seed"], index)})
+
+	def image_path(self, index: int) -> str:
+		filename:str = None
+		if self.config["name"] is None:
+			filename = random_filename()
+		else:
+			filename = self.config["name"]
+			if index != 0:
+				filename += "_" + str(index)
+		return os.path.join(self.out_dir, filename+".png")
+
+	def write_metadata(self):
+		from pipes.noise import image_seed
+		metadata_filename:str = None
+		if self.config["name"] is None:
+			metadata_filename = random_filename()
+		else:
+			metadata_filename = self.config["name"]
+		metadata_file = os.path.join(self.out_dir, metadata_filename+".txt")
+		print("metadata_file: " + metadata_file)
+		with open(metadata_file, mode="w") as f:
+			json.dump({**self.config, "image_seeds": [image_seed(self.config["seed"], i) for i in range(self.config["n"])]}, f, indent=4)
+
+
+def group_runs(runs):
+	''' Group consecutive runs with equal batch keys into lists, so that their images share batches.
+	A group is closed once it has `max_batch_size` images, so at most one batch of configs is read ahead,
+	e.g. of configs streamed from stdin.
+	'''
+	group = []
+	for run in runs:
+		if len(group) > 0 and run.batch_key() != group[0].batch_key():
+			yield group
+			group = []
+		group.append(run)
+		if sum(len(run.indices) for run in group) >= run.max_batch_size:
+			yield group
+			group = []
+	if len(group) > 0:
+		yield group
+
+def run_group(runs: list, pipe, manifest: Manifest = None, progress: Progress = None):
+	''' Generate the images of `runs`, which have equal batch keys, in shared batches and save them. '''
+	from pipes.result_cache import iter_cached_items
+	from pipes.memory import format_run
+	from pipes.metrics import metrics
+	from png_cache import shared_png_cache
+
+	items = [(run, i) for run in runs for i in run.indices]
+	kwargs = {**runs[0].kwargs, "pipe": pipe}
+	# Images already generated with the same model, arguments and seed are read from the result cache
+	predict_func = get_predict_func(runs[0].mode)
+	params_key = None if pipe.result_cache is None else pipe.result_cache.params_key(predict_func, kwargs)
+	last_run = pipe.last_run
+	done = 0
+	for res_images in iter_cached_items(pipe.result_cache, params_key, predict_func,
+		[run.prompt for run, _ in items],
+		[generator for run in runs for generator in run.generators],
+		runs[0].max_batch_size,
+		**kwargs
+	):
+		for res_image in res_images:
+			run, i = items[done]
+			filepath = run.image_path(i)
+			print(f"{i}/{run.config['n']}: {filepath}")
+
+			## Save result image
+			# Through the shared PNG cache, so the result cache writes the same encoding
+			with metrics.span("save_image"):
+				with open(filepath, "wb") as f:
+					f.write(shared_png_cache().encode_with_text(res_image, "stable diffusion", run.png_metadata(i)))
+			if not manifest is None:
+				manifest.record(run.key, i, filepath)
+			if not progress is None:
+				print(progress.update())
+			done += 1
+		# Batches read from the result cache do not run the pipe
+		if not pipe.last_run is last_run:
+			last_run = pipe.last_run
+			print(format_run(last_run))
+	print(f"Text embedding cache: {pipe.text_encoder_cache.stats()}")
+	if not pipe.result_cache is None:
+		pipe.result_cache.flush()
+		print(f"Result cache: {pipe.result_cache.stats()}")
+
+def write_metrics():
+	''' Write the metrics to INPAINT_METRICS_FILE if set. Only main.py does, not the workers of the pool. '''
+	from pipes.metrics import metrics
+	if "INPAINT_METRICS_FILE" in os.environ:
+		metrics.write(os.environ["INPAINT_METRICS_FILE"])
+
+def prepare_run(config: dict, mode: str, kwargs: dict, out_dir: str, image_paths: list = [], manifest: Manifest = None, indices: list = None) -> ConfigRun:
+	''' The run of the images of `config` not recorded in `manifest`, or of `indices` if given,
+	e.g. to regenerate one image of a batch. Writes its metadata file. None if there is nothing to generate.
+	'''
+	if indices is None:
+		indices = remaining_indices(config, mode, image_paths, manifest)
+	if len(indices) == 0:
+		print("All images are generated already, skip.")
+		return None
+	run = ConfigRun(config, mode, kwargs, out_dir, image_paths, indices, manifest=manifest)
+	run.write_metadata()
+	return run
+
+def run_configs(runs, pipe, manifest: Manifest = None, progress: Progress = None):
+	''' Generate `runs`, an iterable of `ConfigRun` or None, consecutive compatible runs sharing batches. '''
+	for group in group_runs(run for run in runs if not run is None):
+		run_group(group, pipe, manifest, progress)
+		write_metrics()
+
+def run_config(config: dict, mode: str, pipe, kwargs: dict, out_dir: str, image_paths: list = [], manifest: Manifest = None, progress: Progress = None, indices: list = None):
+	''' Generate the images of `config` into `out_dir`, see `prepare_run`. '''
+	run_configs([prepare_run(config, mode, kwargs, out_dir, image_paths, manifest, indices)], pipe, manifest, progress)
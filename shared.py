@@ -6,34 +6,65 @@ def random_filename():
 
 
 def load_config(config_filepath):
-	import json
-	with open(config_filepath, mode="r", encoding="utf8") as f:
-		configs = json.load(f)
-	config = configs[0]
-	return config
+	from runner import load_configs
+	return next(load_configs(config_filepath))
 
 @st.experimental_singleton
 def get_check_prompt_func():
 	from check_prompt import check_prompt_length
 	return check_prompt_length
 
+@st.experimental_singleton
+def get_png_cache():
+	from png_cache import shared_png_cache
+	from pipes.metrics import metrics
+	png_cache = shared_png_cache()
+	metrics.gauge("inpaint_png_cache_hits", lambda: png_cache.stats()["hits"])
+	metrics.gauge("inpaint_png_cache_misses", lambda: png_cache.stats()["misses"])
+	return png_cache
+
 def img2bytes(image):
-	# we have to convert PIL.Image to BytesIO for downloading.
+	# we have to convert PIL.Image to bytes for downloading.
 	# see https://discuss.streamlit.io/t/how-to-download-image/3358/10
-	from io import BytesIO
-	image_buf = BytesIO()
-	image.save(image_buf, format="png")
-	return image_buf.getvalue()
-
-def zip_bytes_or_strs(filenames, bytes_or_strs) -> bytes:
-	assert(len(filenames) == len(bytes_or_strs))
-	from zipfile import ZipFile
-	import io
-	zip_bytes_io = io.BytesIO()
-	with ZipFile(zip_bytes_io, "w") as zip_file:
-		for i in range(len(bytes_or_strs)):
-			zip_file.writestr(filenames[i], bytes_or_strs[i])
-	return zip_bytes_io.getvalue()
+	# Encoded bytes are cached, so reruns do not encode the same image again.
+	return get_png_cache().encode(image)
+
+def make_zip_settings():
+	with st.sidebar.expander("Export", expanded=False):
+		compression = st.radio("zip_compression", options=["store", "deflate"], index=0, horizontal=True, key="zip_compression",
+			help="PNGs are already compressed, store is much faster than deflate.")
+		on_disk = st.checkbox("zip_on_disk", value=False, key="zip_on_disk",
+			help="If True, the zip is built in a temporary file on server instead of memory.")
+	return compression, on_disk
+
+def zip_results(entries, compression, on_disk):
+	''' Zip (filename, image or str) entries, returns bytes, or a temporary file's path if `on_disk`. '''
+	from export import zip_to_bytes, zip_to_tempfile
+	encode = get_png_cache().encode
+	if on_disk:
+		return zip_to_tempfile(entries, compression=compression, encode=encode)
+	return zip_to_bytes(entries, compression=compression, encode=encode)
+
+def set_zip_file(zip_file):
+	# Delete the last zip if it is a temporary file
+	import os
+	last_zip_file = st.session_state.get("zip_file", None)
+	if isinstance(last_zip_file, str) and os.path.exists(last_zip_file):
+		os.remove(last_zip_file)
+	st.session_state["zip_file"] = zip_file
+
+def make_zip_download_btn(label):
+	zip_file = st.session_state.get("zip_file", None)
+	if isinstance(zip_file, str):
+		with open(zip_file, mode="rb") as f:
+			return st.download_button(label, data=f, file_name="images.zip", mime="application/zip")
+	return st.download_button(
+		label,
+		data=zip_file if zip_file else "",
+		file_name="images.zip",
+		mime="application/zip",
+		disabled=zip_file is None,
+	)
 
 def make_image_download_btn(image, label, filename, key=None):
 	return st.download_button(
@@ -45,6 +76,38 @@ def make_image_download_btn(image, label, filename, key=None):
 		key=key if key else label,
 	)
 
+def make_tile_settings(config):
+	tiled = st.checkbox("tiled", value=config.get("tile_size", None) is not None, key="tiled",
+		help="If True, the model works on overlapping tiles, so memory is bounded by tile_size instead of the image size. Needed for large images.")
+	if not tiled:
+		return None, 64
+	tile_size = st.number_input("tile_size", min_value=128, value=config.get("tile_size", None) or 512, step=64, format="%i", key="tile_size",
+		help="Rounded down to a multiple of 64.")
+	tile_overlap = st.number_input("tile_overlap", min_value=0, value=config.get("tile_overlap", 64), step=64, format="%i", key="tile_overlap",
+		help="Rounded down to a multiple of 64, at most half of tile_size.")
+	return tile_size, tile_overlap
+
+def make_memory_profile_select(config):
+	options = ["fast", "balanced", "low-memory"]
+	return st.selectbox("memory_profile", options=options, index=options.index(config.get("memory_profile", "fast")), key="memory_profile",
+		help="fast: no memory saving. balanced: slice attention & vae decoding. low-memory: also keep unused big models on cpu.")
+
+def make_sampler_select(config):
+	from pipes.samplers import sampler_names
+	options = sampler_names()
+	sampler = config.get("sampler", "ddim")
+	return st.selectbox("sampler", options=options, index=options.index(sampler) if sampler in options else 0, key="sampler",
+		help="Sampling method. dpm-solver needs far fewer steps, e.g. 20 instead of 50.")
+
+def make_image_index_input(n):
+	return st.number_input("image_index", min_value=-1, max_value=n-1, value=-1, step=1, format="%i", key="image_index",
+		help="-1 generates all n images. Otherwise only the image of this index is generated, the same as in the batch of n with the same seed.")
+
+def image_seeds(seed, indices) -> dict:
+	''' Index => seed of the image, for metadata. '''
+	from pipes.noise import image_seed
+	return {str(index): image_seed(seed, index) for index in indices}
+
 def make_prompt_area(default_prompt):
 	prompt = st.text_area("prompt", value=default_prompt, key="prompt",
 		help="Prompt to guide AI.")
@@ -53,4 +116,61 @@ def make_prompt_area(default_prompt):
 		st.success(f"Prompt has {prompt_len} tokens <= {max_prompt_len}.")
 	else:
 		st.warning(f"Prompt has {prompt_len} tokens > {max_prompt_len}!!!")
-	return prompt
\ No newline at end of file
+	return prompt
+
+def get_session_id():
+	try:
+		from streamlit.runtime.scriptrunner import get_script_run_ctx
+	except ImportError:
+		from streamlit.scriptrunner import get_script_run_ctx
+	return get_script_run_ctx().session_id
+
+def submit_job(label, func, n, max_batch_size, info, **kwargs):
+	''' Queue a job to the generation worker for this session. '''
+	from pipes.worker import QueueFullError
+	worker = st.session_state["worker"]
+	try:
+		job = worker.submit(get_session_id(), func, n, max_batch_size, info=info, **kwargs)
+	except QueueFullError:
+		st.warning(f"Server is busy, {label} is not queued. Please try again later.")
+		return
+	st.session_state["job_id"] = job.job_id
+
+def poll_job(label, poll_interval=1.0):
+	''' Show the status, the previews and a cancel button of this session's job and rerun until it finishes.
+	Returns the job once when it is done or cancelled, otherwise None.
+	'''
+	worker = st.session_state["worker"]
+	job_id = st.session_state.get("job_id", None)
+	if job_id is None:
+		return None
+	job = worker.get(job_id)
+	if job is None:
+		st.session_state["job_id"] = None
+		return None
+
+	if job.finished:
+		worker.remove(job_id)
+		st.session_state["job_id"] = None
+		if job.status == "failed":
+			st.error(f"{label} failed: {job.error!r}")
+			return None
+		if job.status == "cancelled":
+			st.warning(f"{label} cancelled, {len(job.images)}/{job.n} images were done.")
+		return job
+
+	if st.button("Cancel", key="cancel_job"):
+		worker.cancel(job_id)
+	if job.cancel_requested:
+		st.info(f"Cancelling {label}...")
+	elif job.status == "queued":
+		st.info(f"{label} queued, {worker.position(job)} jobs ahead.")
+	else:
+		st.info(f"{label}... {len(job.images)}/{job.n}, step {job.step}/{job.total_steps} (seed:{job.info.get('seed', '')})")
+		st.progress(job.progress)
+		previews = job.previews
+		if len(previews) > 0:
+			st.image(previews, width=min(256, previews[0].size[0]))
+	import time
+	time.sleep(poll_interval)
+	st.experimental_rerun()
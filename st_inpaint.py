@@ -7,8 +7,8 @@ import os.path
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 from io import BytesIO
-from shared import img2bytes, random_filename, load_config, make_prompt_area, make_image_download_btn, zip_bytes_or_strs
-import torch
+from image_store import ImageStore
+from shared import make_tile_settings, make_memory_profile_select, make_sampler_select, make_image_index_input, image_seeds, get_png_cache, random_filename, load_config, make_prompt_area, make_image_download_btn, submit_job, poll_job, make_zip_settings, zip_results, set_zip_file, make_zip_download_btn
 
 default_configfile_path = os.path.join(st.session_state["root_dir"], "config/inpaint.json")
 default_out_path = os.path.join(st.session_state["root_dir"], "out")
@@ -33,7 +33,8 @@ def render():
 				help="If True, a json file containing the config when generating the image will be saved, with .meta.json extension.")
 	config = st.session_state["config"]
 	out_dir = st.session_state["out_dir"]
-	pipe = st.session_state["pipe"]
+
+	image_store = st.session_state.setdefault("image_store", ImageStore())
 
 	## Input
 	with st.sidebar.expander("Input", expanded=True):
@@ -42,13 +43,11 @@ def render():
 			upload_init_image = st.file_uploader("init_image", type=["png", "jpg", "bmp"], key="upload_init_image_uploader")
 			submitted = st.form_submit_button("Submit")
 			if submitted:
-				st.session_state["sel_image"] = None
-				st.session_state["upload_image"] = upload_init_image
+				st.session_state["init_image"] = image_store.add_file(upload_init_image) if upload_init_image else None
 		init_mask_json = st.file_uploader("mask_json", type=["json"], key="upload_mask_json_uploader")
 
 		if clear_canvas:
-			st.session_state["sel_image"] = None
-			st.session_state["upload_image"] = None
+			st.session_state["init_image"] = None
 
 	## Tool settings
 	with st.sidebar.expander("Tool", expanded=True):
@@ -61,6 +60,7 @@ def render():
 			help="How many pictures are shown in the result row?")
 		save_on_select = st.checkbox("save_on_select", value=True,
 			help="If True, image will be saved upon `Select` is pressed.")
+	zip_compression, zip_on_disk = make_zip_settings()
 
 	## Inpaint Settings
 	with st.sidebar.expander("Inpaint", expanded=True):
@@ -71,13 +71,28 @@ def render():
 		else:
 			keep_origin = st.checkbox("keep_origin", value=config["keep_origin"], key="keep_origin",
 				help="If False, the unmasked part will also be modified. Though the change is small, it may be significant after multiple iterations.")
+		crop_to_mask = st.checkbox("crop_to_mask", value=config.get("crop_to_mask", False), key="crop_to_mask",
+			help="If True, only the bounding box of the mask is inpainted at model resolution and blended back. Much faster for small masks on large images.")
+		if crop_to_mask:
+			crop_padding = st.number_input("crop_padding", min_value=0, value=config.get("crop_padding", 32), step=8, format="%i", key="crop_padding",
+				help="Pixels of context around the mask's bounding box.")
+			crop_resolution = st.number_input("crop_resolution", min_value=64, value=config.get("crop_resolution", 512), step=64, format="%i", key="crop_resolution",
+				help="The longer side of the crop is scaled to this size for inpainting.")
+		else:
+			crop_padding, crop_resolution = 32, 512
 		strength = st.number_input("strength", min_value=0.0, max_value=1.0, value=config["strength"], step=0.01, key="strength",
 			help="Repaint strength.")
+		tile_size, tile_overlap = make_tile_settings(config)
+		memory_profile = make_memory_profile_select(config)
+		sampler = make_sampler_select(config)
 		num_inference_steps = st.number_input("num_inference_steps", min_value=0, value=config["num_inference_steps"], step=5, format="%i", key="num_inference_steps")
 		guidance_scale = st.slider("guidance_scale", min_value=1.0, max_value=50.0, value=config["guidance_scale"], step=0.1, format="%f", key="guidance_scale")
 		eta = st.slider("eta", min_value=0.0, max_value=1.0, value=config["eta"], step=0.05, key="eta")
 		seed = st.number_input("seed", min_value=0, value=0 if config["seed"] is None else config["seed"], step=1, format="%i", key="seed", 
 			help="0 means to use random seed.")
+		image_index = make_image_index_input(n)
+		max_batch_size = st.number_input("max_batch_size", min_value=1, value=config.get("max_batch_size", 1), step=1, format="%i", key="max_batch_size",
+			help="How many pictures are generated together at most? Larger is faster but needs more memory. Halved automatically when out of memory.")
 
 
 
@@ -85,15 +100,9 @@ def render():
 	## Prompt
 	prompt = make_prompt_area(config["prompt"])
 
-	## get init_image
-	upload_init_image = st.session_state.get("upload_image", default=None)
-	sel_init_image = st.session_state.get("sel_image", default=None)
-
-	init_image = None
-	if sel_init_image:
-		init_image = sel_init_image
-	elif upload_init_image:
-		init_image = Image.open(upload_init_image)
+	## get init_image, decoded & fingerprinted once by the image store
+	init_image_handle = st.session_state.get("init_image", default=None)
+	init_image = init_image_handle.image if init_image_handle else None
 
 	## get init_mask_json
 	if init_mask_json is None:
@@ -103,7 +112,7 @@ def render():
 
 	## use image's hash to enforce the canvas to re-render
 	## see https://github.com/andfanilo/streamlit-drawable-canvas/issues/73
-	init_image_hash = hashlib.sha256(init_image.tobytes()).hexdigest() if init_image else "sadjfiojeio"
+	init_image_hash = init_image_handle.fingerprint if init_image_handle else "sadjfiojeio"
 
 	## canvas to draw the mesh
 	canvas_result = st_canvas(
@@ -128,7 +137,7 @@ def render():
 	upload_mask_image = st.file_uploader("mask_image", type=["png", "jpg", "bmp"], key="upload_mask_image_uploader")
 	if upload_mask_image:
 		st.info("Using uploaded mask_image.")
-		mask_image = Image.open(upload_mask_image)
+		mask_image = image_store.add_file(upload_mask_image).image
 		st.image(mask_image, use_column_width="never")
 	elif not canvas_result.image_data is None:
 		## Convert canvas's mask_image to PIL.Image with mode of 'RGB'
@@ -163,39 +172,48 @@ def render():
 	# Inpaint
 	if do_inpaint:
 		import pipes.inpaint
-		# Set Seed
-		cuda_seed = torch.Generator(device='cuda')
-		manual_seed = seed
-		if manual_seed == 0:
-			seed = str(cuda_seed.seed())
-		else:
-			cuda_seed = cuda_seed.manual_seed(manual_seed)
+		from pipes.backend import backend
+		from pipes.noise import image_generators
+
+		# Set Seed, each image gets its own generator seeded from the seed and its index
+		if seed == 0:
+			seed = str(backend.generator().seed())
+		indices = list(range(n)) if image_index < 0 else [image_index]
+		generators = image_generators(seed, indices)
 
 		# Set mask to all white if all_mask is True
 		if all_mask:
 			mask_image = Image.new(mode="RGB", size=init_image.size, color=(255, 255, 255))
 
-		# Evaluate
-		st.session_state["res_images"] = []
-		with st.spinner(f"Inpainting... (seed:{seed})"):
-			prog_bar = st.progress(0)
-			for i in range(n):
-				st.session_state["res_images"].append(pipes.inpaint.predict(
-					pipe=pipe,
-					prompt=prompt,
-					init_image=init_image,
-					mask_image=mask_image,
-					keep_origin=keep_origin,
-					strength=strength,
-					num_inference_steps=num_inference_steps,
-					guidance_scale=guidance_scale,
-					eta=eta,
-					generator=cuda_seed,
-				))
-				prog_bar.progress((i+1)/n)
+		# Queue to the worker
+		submit_job("Inpainting", pipes.inpaint.predict, len(indices), max_batch_size, {"seed": seed, "indices": indices},
+			prompt=prompt,
+			init_image=init_image,
+			mask_image=mask_image,
+			keep_origin=keep_origin,
+			crop_to_mask=crop_to_mask,
+			crop_padding=crop_padding,
+			crop_resolution=crop_resolution,
+			strength=strength,
+			num_inference_steps=num_inference_steps,
+			guidance_scale=guidance_scale,
+			eta=eta,
+			tile_size=tile_size,
+			tile_overlap=tile_overlap,
+			memory_profile=memory_profile,
+			sampler=sampler,
+			generator=generators,
+		)
 
+	# Wait for the job & fetch results
+	job = poll_job("Inpainting")
+	if not job is None:
+		st.session_state["res_images"] = job.images
+		st.session_state["res_seed"] = job.info["seed"]
+		# A cancelled job has the images of the first indices
+		st.session_state["res_indices"] = job.info["indices"][:len(job.images)]
 		# Clear zip_file to trigger rezip
-		st.session_state["zip_file"] = None
+		set_zip_file(None)
 	res_images = st.session_state.get("res_images", default=[])
 
 
@@ -212,33 +230,23 @@ def render():
 			"num_inference_steps": num_inference_steps,
 			"guidance_scale": guidance_scale,
 			"eta": eta,
-			"seed": seed,
+			"sampler": sampler,
+			"seed": st.session_state.get("res_seed", seed),
+			"image_seeds": image_seeds(st.session_state.get("res_seed", seed), st.session_state.get("res_indices", [])),
 		}
 		metadata_str = json.dumps(metadata, indent=4)
 		metadata_filename = f"{random_filename()}.meta.json"
 
-		# PIL.Image => bytes
-		img_bytes = []
-		img_names = []
-		for i in range(len(res_images)):
-			img_names.append(random_filename() + ".png")
-			img_bytes.append(img2bytes(res_images[i]))
-
 		# Make zip
-		zip_bytes = zip_bytes_or_strs([*img_names, metadata_filename], [*img_bytes, metadata_str])
-		st.session_state["zip_file"] = zip_bytes
+		entries = [(f"{index}_{random_filename()}.png", img) for index, img in zip(st.session_state.get("res_indices", []), res_images)]
+		entries.append((metadata_filename, metadata_str))
+		set_zip_file(zip_results(entries, zip_compression, zip_on_disk))
 
 
 	# Buttons to download & Control whether to show results
 	cols = st.columns(2)
 	with cols[0]:
-		st.download_button(
-			"Save Results",
-			data=st.session_state.get("zip_file", ""),
-			file_name="images.zip",
-			mime="application/zip",
-			disabled=st.session_state.get("zip_file", None) is None,
-		)
+		make_zip_download_btn("Save Results")
 	with cols[1]:
 		show_result = st.checkbox("show_result", value=True,
 			help="If True, all generated images will shown.")
@@ -279,6 +287,7 @@ def render():
 
 					# Save metadata
 					## Build metadata
+					from pipes.noise import image_seed
 					metadata = {
 						"n": n,
 						"prompt": prompt,
@@ -287,7 +296,10 @@ def render():
 						"num_inference_steps": num_inference_steps,
 						"guidance_scale": guidance_scale,
 						"eta": eta,
-						"seed": seed,
+						"sampler": sampler,
+						"seed": st.session_state.get("res_seed", seed),
+						"index": st.session_state["res_indices"][i],
+						"image_seed": image_seed(st.session_state.get("res_seed", seed), st.session_state["res_indices"][i]),
 					}
 
 					## Save metadata
@@ -302,18 +314,15 @@ def render():
 					## Gen filename
 					filepath = os.path.join(out_dir, filename+".png")
 
-					## Build Png Metadata
-					png_metadata = PngInfo()
-					png_metadata.add_text("stable diffusion", json.dumps(metadata))
-					
-					## Save selected image
+					## Save selected image with Png Metadata
 					st.text(f"Save image {filepath}")
 					print(f"Save image {filepath}")
-					img.save(filepath, pnginfo=png_metadata)
+					from pipes.metrics import metrics
+					with metrics.span("save_image"), open(filepath, mode="wb") as f:
+						f.write(get_png_cache().encode_with_text(img, "stable diffusion", json.dumps(metadata)))
 
 				# Select
-				st.session_state["sel_image"] = img
-				st.session_state["upload_image"] = None
+				st.session_state["init_image"] = image_store.add_image(img)
 				st.experimental_rerun()
 	else: # show_result == False
 		# Do not show result
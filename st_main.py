@@ -27,22 +27,50 @@ st.set_page_config(page_title="Inpaint", layout="wide")
 # A place to information
 info_bar = st.empty()
 
-# Long time import
-info_bar.info("Loading pytorch...")
-import torch
-info_bar.empty()
+# Start loading pipe in background, it is waited for only when drawing
+@st.experimental_singleton
+def GetPipe():
+	from pipes.get_pipe import lazy_pipe
+	return lazy_pipe.start()
+st.session_state["pipe"] = GetPipe()
+
+# One worker owns the pipe and runs the jobs of all sessions
+@st.experimental_singleton
+def GetWorker():
+	from pipes.worker import GenerationWorker
+	return GenerationWorker(GetPipe(),
+		max_queue_depth=int(os.environ.get("INPAINT_MAX_QUEUE_DEPTH", 16)),
+		batch_window=float(os.environ.get("INPAINT_BATCH_WINDOW", 0.1)),
+		preview_every=int(os.environ.get("INPAINT_PREVIEW_EVERY", 5)),
+	)
+st.session_state["worker"] = GetWorker()
+
+@st.experimental_singleton
+def GetMetricsServer():
+	from pipes.metrics import metrics
+	if not metrics.enabled or not "INPAINT_METRICS_PORT" in os.environ:
+		return None
+	return metrics.serve(int(os.environ["INPAINT_METRICS_PORT"]))
+GetMetricsServer()
 
 # Sidebar
 ## Mode
 mode = st.sidebar.radio("mode", ["txt2img", "inpaint"], index=0)
+if not st.session_state["pipe"].ready():
+	st.sidebar.info("Loading model in background...")
+with st.sidebar.expander("Worker", expanded=False):
+	st.json(st.session_state["worker"].stats.summary())
+	if st.session_state["pipe"].ready():
+		st.json(st.session_state["pipe"].get().text_encoder_cache.stats())
+		if not st.session_state["pipe"].get().result_cache is None:
+			st.json(st.session_state["pipe"].get().result_cache.stats())
+		last_run = st.session_state["pipe"].get().last_run
+		if last_run:
+			from pipes.memory import format_run
+			st.text(format_run(last_run))
 
 
 # Mode Select
-@st.experimental_singleton
-def GetPipe():
-	from pipes.get_pipe import pipe
-	return pipe
-st.session_state["pipe"] = GetPipe()
 
 
 if mode == "inpaint":
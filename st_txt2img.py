@@ -8,8 +8,7 @@ import os.path
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 from io import BytesIO
-from shared import load_config, make_prompt_area, random_filename
-import torch
+from shared import make_tile_settings, make_memory_profile_select, make_sampler_select, make_image_index_input, image_seeds, load_config, make_prompt_area, random_filename, submit_job, poll_job, make_zip_settings, zip_results, set_zip_file, make_zip_download_btn
 
 default_configfile_path = os.path.join(st.session_state["root_dir"], "config/txt2img.json")
 
@@ -24,7 +23,6 @@ def render():
 			st.session_state["config"] = load_config(config_filepath)
 			st.info("Config loaded.")
 	config = st.session_state["config"]
-	pipe = st.session_state["pipe"]
 
 	## Tool settings
 	with st.sidebar.expander("Tool", expanded=True):
@@ -32,6 +30,7 @@ def render():
 			help="How many pictures are shown in the result row?")
 		show_result = st.checkbox("show_result", value=False,
 			help="If True, all generated images will shown.")
+	zip_compression, zip_on_disk = make_zip_settings()
 
 	## txt2img Settings
 	with st.sidebar.expander("Inpaint", expanded=True):
@@ -39,11 +38,17 @@ def render():
 			help="How many pictures to generate?")
 		width = st.number_input("width", min_value=64, value=config["width"], step=64, format="%i", key="width")
 		height = st.number_input("height", min_value=64, value=config["height"], step=64, format="%i", key="height")
+		tile_size, tile_overlap = make_tile_settings(config)
+		memory_profile = make_memory_profile_select(config)
+		sampler = make_sampler_select(config)
 		num_inference_steps = st.slider("num_inference_steps", min_value=0, max_value=100, value=config["num_inference_steps"], step=5, format="%i", key="num_inference_steps")
 		guidance_scale = st.slider("guidance_scale", min_value=1.0, max_value=50.0, value=config["guidance_scale"], step=0.5, format="%f", key="guidance_scale")
 		eta = st.slider("eta", min_value=0.0, max_value=1.0, value=config["eta"], step=0.05, key="eta")
 		seed = st.number_input("seed", min_value=0, value=0 if config["seed"] is None else config["seed"], step=1, format="%i", key="seed", 
 			help="0 means to use random seed.")
+		image_index = make_image_index_input(n)
+		max_batch_size = st.number_input("max_batch_size", min_value=1, value=config.get("max_batch_size", 1), step=1, format="%i", key="max_batch_size",
+			help="How many pictures are generated together at most? Larger is faster but needs more memory. Halved automatically when out of memory.")
 
 
 	# Work area
@@ -55,35 +60,41 @@ def render():
 		label="Draw",
 	)
 	
-	import pipes.txt2img
-
 	if do_draw:
-		# Set Seed
-		cuda_seed = torch.Generator(device='cuda')
-		manual_seed = seed
-		if manual_seed == 0:
-			seed = str(cuda_seed.seed())
-		else:
-			cuda_seed = cuda_seed.manual_seed(manual_seed)
-
-		# Evaluate
-		st.session_state["res_images"] = []
-		with st.spinner(f"Drawing... (seed:{seed})"):
-			prog_bar = st.progress(0)
-			for i in range(n):
-				st.session_state["res_images"].append(pipes.txt2img.predict(
-					pipe=pipe,
-					prompt=prompt,
-					height=height,
-					width=width,
-					num_inference_steps=num_inference_steps,
-					guidance_scale=guidance_scale,
-					eta=eta,
-					generator=cuda_seed,
-				))
-				prog_bar.progress((i+1)/n)
-			# Clear zip_file to trigger rezip
-			st.session_state["zip_file"] = None
+		import pipes.txt2img
+		from pipes.backend import backend
+		from pipes.noise import image_generators
+
+		# Set Seed, each image gets its own generator seeded from the seed and its index
+		if seed == 0:
+			seed = str(backend.generator().seed())
+		indices = list(range(n)) if image_index < 0 else [image_index]
+		generators = image_generators(seed, indices)
+
+		# Queue to the worker
+		submit_job("Drawing", pipes.txt2img.predict, len(indices), max_batch_size, {"seed": seed, "indices": indices},
+			prompt=prompt,
+			height=height,
+			width=width,
+			num_inference_steps=num_inference_steps,
+			guidance_scale=guidance_scale,
+			eta=eta,
+			tile_size=tile_size,
+			tile_overlap=tile_overlap,
+			memory_profile=memory_profile,
+			sampler=sampler,
+			generator=generators,
+		)
+
+	# Wait for the job & fetch results
+	job = poll_job("Drawing")
+	if not job is None:
+		st.session_state["res_images"] = job.images
+		st.session_state["res_seed"] = job.info["seed"]
+		# A cancelled job has the images of the first indices
+		st.session_state["res_indices"] = job.info["indices"][:len(job.images)]
+		# Clear zip_file to trigger rezip
+		set_zip_file(None)
 	res_images = st.session_state.get("res_images", default=[])
 
 
@@ -98,41 +109,21 @@ def render():
 			"num_inference_steps": num_inference_steps,
 			"guidance_scale": guidance_scale,
 			"eta": eta,
-			"seed": seed,
+			"sampler": sampler,
+			"seed": st.session_state.get("res_seed", seed),
+			"image_seeds": image_seeds(st.session_state.get("res_seed", seed), st.session_state.get("res_indices", [])),
 		}
 
 		## zip images & metadata
-		from zipfile import ZipFile
-		import io
-		zip_bytes_io = io.BytesIO()
-		with ZipFile(zip_bytes_io, "w") as zip_file:
-			# metadata
-			zip_file.writestr(f"{random_filename()}.meta.json", json.dumps(metadata, indent=4))
-
-			# imgs
-			for i in range(len(images)):
-				imgname = random_filename() + ".png"
-				img = images[i]
-
-				# PIL.Image => io.BytesIO
-				img_bytes_io = io.BytesIO()
-				img.save(img_bytes_io, "PNG")
-
-				# Write to zip
-				zip_file.writestr(imgname, img_bytes_io.getvalue())
-		return zip_bytes_io.getvalue()
+		entries = [(f"{random_filename()}.meta.json", json.dumps(metadata, indent=4))]
+		entries += [(f"{index}_{random_filename()}.png", img) for index, img in zip(st.session_state.get("res_indices", []), images)]
+		return zip_results(entries, zip_compression, zip_on_disk)
 
 	if len(res_images) > 0 and st.session_state.get("zip_file", None) is None:
-		st.session_state["zip_file"] = ZipImages(res_images)
+		set_zip_file(ZipImages(res_images))
 
 	# Button to download
-	st.download_button(
-		"Save",
-		data=st.session_state.get("zip_file", ""),
-		file_name="images.zip",
-		mime="application/zip",
-		disabled=st.session_state.get("zip_file", None) is None,
-	)
+	make_zip_download_btn("Save")
 
 
 	# Result Images
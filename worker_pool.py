@@ -0,0 +1,178 @@
+import os
+import queue
+import traceback
+from runner import Manifest, Progress, ConfigRun, remaining_indices, group_runs, run_group, write_metrics
+
+
+####################################
+# Worker process
+####################################
+class _ResultManifest:
+	''' Manifest inside a worker, records are sent to the parent which owns the manifest file. '''
+	def __init__(self, results):
+		self.results = results
+
+	def record(self, key: str, index: int, filepath: str):
+		self.results.put(("image", key, index, filepath))
+
+
+def _worker_main(worker_id: int, cores: list, components: dict, jobs, results, out_dir: str):
+	import torch
+	from diffusers import StableDiffusionPipeline
+	from pipes.get_pipe import PipeRegistry
+	from pipes.metrics import metrics
+
+	os.sched_setaffinity(0, cores)
+	torch.set_num_threads(len(cores))
+	pipe = PipeRegistry(StableDiffusionPipeline(**components))
+	while True:
+		unit = jobs.get()
+		if unit is None:
+			break
+		unit_index, parts = unit
+		try:
+			runs = [ConfigRun(config, mode, kwargs, out_dir, [], indices, key) for config, mode, kwargs, indices, key in parts]
+			run_group(runs, pipe, _ResultManifest(results))
+			result = ("done", worker_id, unit_index, None)
+		except Exception:
+			result = ("failed", worker_id, unit_index, traceback.format_exc())
+		# The parent alone writes and serves the metrics
+		if metrics.enabled:
+			results.put(("metrics", worker_id, metrics.take(), None))
+		results.put(result)
+
+
+####################################
+# Worker pool
+####################################
+def split_cores(cores: list, num_workers: int) -> list:
+	''' Split `cores` into `num_workers` contiguous, nearly equal groups. '''
+	cores = sorted(cores)
+	size, rest = divmod(len(cores), num_workers)
+	groups = []
+	start = 0
+	for i in range(num_workers):
+		end = start + size + (1 if i < rest else 0)
+		groups.append(cores[start:end])
+		start = end
+	return groups
+
+
+class WorkerPool:
+	''' Runs jobs on `num_workers` processes, each pinned to its own group of cores and using them
+	all as intra-op threads.
+	The weights of `registry` are moved to shared memory once, the workers map them read-only
+	instead of loading their own copies. Jobs are split into units of at most one batch, a chunk of the
+	images of a config or consecutive compatible small configs, so that a large config spreads over all
+	workers. The parent hands out units one at a time, so a slow one does not hold up the others,
+	and it is the only writer of the manifest and of the metadata files.
+	Only CPU backends are supported.
+	'''
+	def __init__(self, registry, num_workers: int, out_dir: str):
+		import torch
+		import torch.multiprocessing as mp
+		from pipes.backend import backend
+		if backend.device_type != "cpu":
+			raise ValueError(f"The worker pool shares weights in CPU memory, not on {backend.device}.")
+		cores = list(os.sched_getaffinity(0))
+		if num_workers > len(cores):
+			raise ValueError(f"{num_workers} workers but only {len(cores)} cores.")
+
+		# Modules are sent by file name instead of one file descriptor per tensor, which would exceed the fd limit
+		mp.set_sharing_strategy("file_system")
+		components = dict(registry.components)
+		components["text_encoder"] = registry.text_encoder_cache.text_encoder
+		for component in components.values():
+			if isinstance(component, torch.nn.Module):
+				component.share_memory()
+
+		context = mp.get_context("spawn")
+		self.jobs = context.Queue(maxsize=num_workers)
+		self.results = context.Queue()
+		self.workers = [
+			context.Process(target=_worker_main, name=f"worker_{i}", daemon=True,
+				args=(i, worker_cores, components, self.jobs, self.results, out_dir))
+			for i, worker_cores in enumerate(split_cores(cores, num_workers))
+		]
+		for worker in self.workers:
+			worker.start()
+		self.out_dir = out_dir
+		self.failures = []
+
+	def _handle(self, result, manifest: Manifest, progress: Progress):
+		kind, a, b, c = result
+		if kind == "image":
+			manifest.record(a, b, c)
+			if not progress is None:
+				print(progress.update())
+		elif kind == "metrics":
+			from pipes.metrics import metrics
+			metrics.merge(b)
+			write_metrics()
+		elif kind == "failed":
+			print(f"Unit {b} failed on worker {a}:\n{c}")
+			self.failures.append(b)
+		return kind
+
+	def _drain(self, manifest: Manifest, progress: Progress, timeout: float = None):
+		''' Handle results until none is left, or one arrives within `timeout` seconds. Returns the kinds handled. '''
+		kinds = []
+		while True:
+			try:
+				kinds.append(self._handle(self.results.get(timeout=timeout) if timeout else self.results.get_nowait(), manifest, progress))
+			except queue.Empty:
+				return kinds
+			timeout = None
+
+	def _check_alive(self):
+		for worker in self.workers:
+			if not worker.is_alive() and worker.exitcode != 0:
+				raise RuntimeError(f"{worker.name} died with exit code {worker.exitcode}.")
+
+	def _units(self, jobs, manifest: Manifest, indices: list):
+		''' Yield the units of `jobs`, lists of (config, mode, kwargs, indices, manifest key) sharing batches. '''
+		def iter_parts():
+			for config, mode, kwargs, image_paths in jobs:
+				job_indices = remaining_indices(config, mode, image_paths, manifest) if indices is None else indices
+				if len(job_indices) == 0:
+					continue
+				# Seeded once here, so that all chunks of a config share its seed
+				run = ConfigRun(config, mode, kwargs, self.out_dir, image_paths, job_indices, manifest=manifest)
+				run.write_metadata()
+				for start in range(0, len(job_indices), run.max_batch_size):
+					yield ConfigRun(run.config, mode, run.kwargs, self.out_dir, image_paths, job_indices[start:start+run.max_batch_size], run.key)
+		for group in group_runs(iter_parts()):
+			yield [(run.config, run.mode, run.kwargs, run.indices, run.key) for run in group]
+
+	def run(self, jobs, manifest: Manifest, progress: Progress = None, indices: list = None):
+		''' Run `jobs`, an iterable of (config, mode, kwargs, image_paths), and wait for them to finish.
+		Only the images of `indices` are generated if given, otherwise those not recorded in `manifest`.
+		Raises RuntimeError if any unit failed.
+		'''
+		self.failures = []
+		submitted, finished = 0, 0
+		for unit_index, parts in enumerate(self._units(jobs, manifest, indices)):
+			while True:
+				try:
+					self.jobs.put((unit_index, parts), timeout=1.0)
+					break
+				except queue.Full:
+					kinds = self._drain(manifest, progress, timeout=1.0)
+					finished += kinds.count("done") + kinds.count("failed")
+					self._check_alive()
+			submitted += 1
+			kinds = self._drain(manifest, progress)
+			finished += kinds.count("done") + kinds.count("failed")
+
+		while finished < submitted:
+			kinds = self._drain(manifest, progress, timeout=1.0)
+			finished += kinds.count("done") + kinds.count("failed")
+			self._check_alive()
+		if len(self.failures) > 0:
+			raise RuntimeError(f"Units {self.failures} failed.")
+
+	def close(self):
+		for _ in self.workers:
+			self.jobs.put(None)
+		for worker in self.workers:
+			worker.join()